@@ -8,14 +8,21 @@
 
 import argparse
 import glob
+import hashlib
 import json
 import logging
+import mmap
 import os
+import re
 import struct
 import sys
 from collections import OrderedDict
+from collections.abc import MutableMapping
+from concurrent import futures
 from logging import debug
 
+import numpy as np
+
 class Lump():
     bsp_parser_dict = None
 
@@ -29,7 +36,9 @@ class Lump():
             # TODO: warning?
             return
 
-        file_path = file_list[0]
+        self.readBspDirFile(file_list[0])
+
+    def readBspDirFile(self, file_path):
         file_ext = os.path.splitext(file_path)[-1][1:]
         file_name = os.path.splitext(os.path.basename(file_path))[0]
 
@@ -38,6 +47,8 @@ class Lump():
                 blob_file = open(file_path, "rb")
                 self.importLump(blob_file.read())
                 blob_file.close()
+                # raw lump, nothing else to read
+                return
             else:
                 Ui.error("unknown lump file: " + file_name)
 
@@ -77,11 +88,41 @@ class Blob(Lump):
         return self.blob_stream
 
 
+class RecordBlob(Blob):
+    record_dtype = None
+    record_array = None
+
+    def isEmpty(self):
+        return self.record_array is None or not len(self.record_array)
+
+    def importLump(self, blob):
+        if len(blob) % self.record_dtype.itemsize != 0:
+            raise ValueError("funny " + self.__class__.__name__ + " lump size: " + str(len(blob)))
+
+        # zero-copy view of the lump, read-only when the lump is
+        # bytes or a mmap view, use numpy.copy() to edit it
+        self.record_array = np.frombuffer(blob, dtype=self.record_dtype)
+
+    def exportLump(self):
+        return self.record_array.tobytes()
+
+
 class Q3Entities(Lump):
-    entities_as_map = None
+    # "classname" is an entity value, other keywords are entity keys,
+    # all of them are interned as bytes while parsing
+    entity_list = None
+    classname_list = None
+
+    # each entity is a list of [key, value start, value end],
+    # values being slices of entities_bstring
+    entities_bstring = None
+
+    # original lump, exported as is when nothing was modified
+    entities_blob = None
+    is_modified = False
 
     def isEmpty(self):
-        return not self.entities_as_map
+        return not self.entity_list
 
     def validateExtension(self, file_ext):
         return file_ext == "txt"
@@ -94,7 +135,7 @@ class Q3Entities(Lump):
 
     def writeFile(self, file_name):
         entities_file = open(file_name, "wb")
-        entities_file.write(self.exportLump().split(b'\0', 1)[0])
+        entities_file.write(bytes(self.exportLump()).split(b'\0', 1)[0])
         entities_file.close()
         return True
 
@@ -102,19 +143,33 @@ class Q3Entities(Lump):
         self.writeFile(dir_name + os.path.sep + lump_name + os.path.extsep + "txt")
 
     def printString(self):
-        print(bytes.decode(self.exportLump().split(b'\0', 1)[0]))
+        print(bytes.decode(bytes(self.exportLump()).split(b'\0', 1)[0]))
+
+    def getValue(self, keyvalue):
+        return bytes(self.entities_bstring[keyvalue[1]:keyvalue[2]])
+
+    def setValue(self, keyvalue, value):
+        # new values are appended to the buffer,
+        # the original text is never rewritten
+        if not isinstance(self.entities_bstring, bytearray):
+            self.entities_bstring = bytearray(self.entities_bstring)
+
+        start = len(self.entities_bstring)
+        self.entities_bstring += value
+        keyvalue[1], keyvalue[2] = start, len(self.entities_bstring)
+        self.is_modified = True
+
+    def getKeyValueList(self, i):
+        return [(keyvalue[0], self.getValue(keyvalue)) for keyvalue in self.entity_list[i]]
 
     def printList(self):
         print("*** Entities")
-        i = 0
-        for entity in self.entities_as_map.entity_list:
+        for i in range(0, len(self.entity_list)):
             string = ""
-            for thing in entity.thing_list:
-                if isinstance(thing, Map.KeyValue):
-                    string += "\"" + thing.key + "\": \"" + thing.value + "\", "
+            for key, value in self.getKeyValueList(i):
+                string += "\"" + bytes.decode(key) + "\": \"" + bytes.decode(value) + "\", "
 
             print(str(i) + ": [" + string[:-2] + "]")
-            i += 1
 
         print("")
         return True
@@ -122,41 +177,135 @@ class Q3Entities(Lump):
     def printSoundList(self):
         print("*** Entities")
         i = 0
-        for entity in self.entities_as_map.entity_list:
-            found = False
-            for thing in entity.thing_list:
-                if isinstance(thing, Map.KeyValue):
-                    for sound_keyword in Map.q3_sound_keyword_list:
-                        if thing.key.lower() == sound_keyword.lower():
-                            print(str(i) + ": " + thing.value + " [" + sound_keyword + "]")
-                            i += 1
+        for entity in self.entity_list:
+            for keyvalue in entity:
+                key = bytes.decode(keyvalue[0]).lower()
+                for sound_keyword in q3_sound_keyword_list:
+                    if key == sound_keyword.lower():
+                        print(str(i) + ": " + bytes.decode(self.getValue(keyvalue)) + " [" + sound_keyword + "]")
+                        i += 1
 
         print("")
         return True
 
     def substituteKeywords(self, substitution):
-        self.entities_as_map.substituteKeywords(substitution)
+        # substitution: {old keyword: new keyword}, case insensitive,
+        # applied to entity keys and classnames
+        keyword_dict = {}
+        for old_keyword, new_keyword in substitution.items():
+            keyword_dict[old_keyword.lower().encode()] = new_keyword.encode()
+
+        for i in range(0, len(self.entity_list)):
+            for keyvalue in self.entity_list[i]:
+                new_key = keyword_dict.get(keyvalue[0].lower())
+                if new_key is not None and new_key != keyvalue[0]:
+                    keyvalue[0] = new_key
+                    self.is_modified = True
+
+                if keyvalue[0] == b"classname":
+                    new_classname = keyword_dict.get(self.getValue(keyvalue).lower())
+                    if new_classname is not None and new_classname != self.getValue(keyvalue):
+                        self.setValue(keyvalue, new_classname)
+                        self.classname_list[i] = new_classname
 
     def lowerCaseFilePaths(self):
-        self.entities_as_map.lowerCaseFilePaths()
+        file_path_key_list = [keyword.lower().encode() for keyword in q3_file_path_keyword_list]
+
+        for entity in self.entity_list:
+            for keyvalue in entity:
+                if keyvalue[0].lower() in file_path_key_list:
+                    value = self.getValue(keyvalue)
+                    if value != value.lower():
+                        self.setValue(keyvalue, value.lower())
 
     def importLump(self, blob):
+        # Entities are parsed in a single pass. On syntax error
+        # ValueError is raised, the entities parsed before
+        # the error are kept.
+        self.entities_blob = blob
+        self.entities_bstring = bytes(blob)
+        self.is_modified = False
         self.entity_list = []
-        entities_bstring = blob.split(b'\0', 1)[0]
+        self.classname_list = []
 
-        #self.entities_as_map = Map.Map()
-        #self.entities_as_map.numbering_enabled = False
-        #self.entities_as_map.readBlob(entities_bstring)
+        entities_length = self.entities_bstring.find(b'\0')
+        if entities_length == -1:
+            # from a bspdir text file
+            entities_length = len(self.entities_bstring)
+            self.is_modified = True
 
-    def exportLump(self):
-        blob = b''
-        blob += self.entities_as_map.exportFile().encode()
-        blob += b'\0'
+        keyword_dict = {}
+        entity = None
+        classname = None
+        key = None
+
+        for match in q3_entity_token_regex.finditer(self.entities_bstring, 0, entities_length):
+            token_kind = match.lastindex
+
+            if token_kind == 1:
+                # comment
+                continue
+
+            if token_kind == 2 or token_kind == 3:
+                if entity is None:
+                    raise ValueError("unexpected string in entities lump at offset " + str(match.start()))
+
+                if key is None:
+                    key = match.group(token_kind)
+                    key = keyword_dict.setdefault(key, key)
+                else:
+                    keyvalue = [key, match.start(token_kind), match.end(token_kind)]
+                    entity.append(keyvalue)
+
+                    if key == b"classname":
+                        classname = self.getValue(keyvalue)
+                        classname = keyword_dict.setdefault(classname, classname)
+
+                    key = None
+
+            elif match.group(token_kind) == b'{' and entity is None:
+                entity = []
+                classname = None
+
+            elif match.group(token_kind) == b'}' and entity is not None and key is None:
+                self.entity_list.append(entity)
+                self.classname_list.append(classname)
+                entity = None
+
+            else:
+                raise ValueError("unexpected " + repr(match.group(token_kind)) + " in entities lump at offset " + str(match.start()))
+
+        if entity is not None:
+            raise ValueError("unterminated entity in entities lump")
+
+    def exportEntity(self, i):
+        blob = b'{\n'
+        for keyvalue in self.entity_list[i]:
+            blob += b'"' + keyvalue[0] + b'" "' + self.getValue(keyvalue) + b'"\n'
+        blob += b'}\n'
         return blob
 
+    def exportLump(self):
+        if not self.is_modified:
+            return self.entities_blob
+
+        blob_list = [self.exportEntity(i) for i in range(0, len(self.entity_list))]
+        blob_list.append(b'\0')
+        return b''.join(blob_list)
+
+
+class Q3Textures(RecordBlob):
+    # 64 bytes string name
+    # 4 bytes integer flags
+    # 4 bytes integer contents
+    record_dtype = np.dtype([
+        ("name", "S64"),
+        ("flags", "<u4"),
+        ("contents", "<u4"),
+    ])
 
-class Q3Textures(Lump):
-    texture_list = None
+    # name → first texture index, built on first lookup
+    texture_index_dict = None
 
     def int2bstr(self, i):
         return "{0:b}".format(i).zfill(30)
@@ -164,18 +313,27 @@ class Q3Textures(Lump):
     def bstr2int(self, s):
         return int(s, 2)
 
-    def isEmpty(self):
-        return not self.texture_list
-
     def validateExtension(self, file_ext):
         return file_ext == "csv"
 
+    def getName(self, i):
+        # NUL-padded, but there may be garbage after the first NUL
+        return bytes.decode(self.record_array["name"][i].split(b'\0', 1)[0])
+
+    def findTexture(self, name):
+        if self.texture_index_dict is None:
+            self.texture_index_dict = {}
+            for i in range(0, len(self.record_array)):
+                self.texture_index_dict.setdefault(self.getName(i), i)
+
+        return self.texture_index_dict.get(name)
+
     def readFile(self, file_name):
         # TODO: check
         textures_file = open(file_name, 'rb')
 
         textures_file_bstring = textures_file.read()
-        self.texture_list = []
+        texture_list = []
 
         for texture_line_bstring in textures_file_bstring.split(b'\n'):
             # TODO: check 3 comma minimum
@@ -184,23 +342,25 @@ class Q3Textures(Lump):
                 bstring_list = texture_line_bstring.split(b',')
                 flags = self.bstr2int(bstring_list[0])
                 contents = self.bstr2int(bstring_list[1])
-                name = bytes.decode(bstring_list[2])
-                self.texture_list.append({"name": name, "flags": flags, "contents": contents})
+                texture_list.append((bstring_list[2], flags, contents))
 
         textures_file.close()
 
+        self.record_array = np.array(texture_list, dtype=self.record_dtype)
+        self.texture_index_dict = None
+
         return True
 
     def writeFile(self, file_name):
-        textures_string = ""
-        for i in range(0, len(self.texture_list)):
-            textures_string += self.int2bstr(self.texture_list[i]["flags"]) + ","
-            textures_string += self.int2bstr(self.texture_list[i]["contents"]) + ","
-            textures_string += self.texture_list[i]["name"] + "\n"
+        textures_string_list = []
+        for i in range(0, len(self.record_array)):
+            textures_string_list.append(self.int2bstr(int(self.record_array["flags"][i])) + ",")
+            textures_string_list.append(self.int2bstr(int(self.record_array["contents"][i])) + ",")
+            textures_string_list.append(self.getName(i) + "\n")
 
         # TODO: check
         textures_file = open(file_name, "wb")
-        textures_file.write(textures_string.encode())
+        textures_file.write("".join(textures_string_list).encode())
         textures_file.close()
 
     def writeBspDirLump(self, dir_name, lump_name):
@@ -210,56 +370,20 @@ class Q3Textures(Lump):
         # TODO: check
 
         print("*** Textures:")
-        for i in range(0, len(self.texture_list)):
-            print(str(i) + ": " + self.texture_list[i]["name"] + " [" + self.int2bstr(self.texture_list[i]["flags"]) + ", " + self.int2bstr(self.texture_list[i]["contents"]) + "]")
+        for i in range(0, len(self.record_array)):
+            print(str(i) + ": " + self.getName(i) + " [" + self.int2bstr(int(self.record_array["flags"][i])) + ", " + self.int2bstr(int(self.record_array["contents"][i])) + "]")
         print("")
 
     def lowerCaseFilePaths(self):
-        textures_count = len(self.texture_list)
-
-        for i in range(0, textures_count):
-            self.texture_list[i]["name"] = self.texture_list[i]["name"].lower()
+        # the imported array may be a read-only view of the lump
+        self.record_array = self.record_array.copy()
+        self.record_array["name"] = np.char.lower(self.record_array["name"])
+        self.texture_index_dict = None
 
     def importLump(self, blob):
         # TODO: check exists
-
-        # 64 bytes string name
-        # 4 bytes integer flags
-        # 4 bytes integer contents
-        textures_count = int(len(blob) / 72)
-
-        self.texture_list = []
-
-        # TODO: check
-
-        for i in range(0, textures_count):
-            offset = i * 72
-            bstring = blob[offset:offset + 64]
-            name = bytes.decode(bstring.split(b'\0', 1)[0])
-            flags, contents = struct.unpack('<II', blob[offset + 64: offset + 72])
-            self.texture_list.append({})
-            self.texture_list[i]["name"] = name
-            self.texture_list[i]["flags"] = flags
-            self.texture_list[i]["contents"] = contents
-
-    def exportLump(self):
-        blob = b''
-
-        for i in range(0, len(self.texture_list)):
-
-                flags_buint=(self.texture_list[i]["flags"]).to_bytes(4, "little")
-                contents_buint=(self.texture_list[i]["contents"]).to_bytes(4, "little")
-
-                # Always add \x00, then pad
-                name_bstring = (self.texture_list[i]["name"]).encode() + b'\0'
-
-                # TODO: check < 64
-                for i in range(0, (64 - len(name_bstring))):
-                    name_bstring += b'\0'
-
-                blob += name_bstring + flags_buint + contents_buint
-
-        return blob
+        RecordBlob.importLump(self, blob)
+        self.texture_index_dict = None
 
 
 class Q3Lightmaps(Lump):
@@ -287,67 +411,70 @@ class Q3Lightmaps(Lump):
 
     def readDir(self, dir_name):
         # TODO: check if a dir, perhaps argparse can do
-        self.lightmap_list = []
         file_list = sorted(glob.glob(dir_name + os.path.sep + "lm_*" + os.path.extsep + "*"))
-        for file_name in file_list:
-            debug("loading lightmap: " + file_name)
-            image = Image.open(file_name)
-            lightmap = image.convert(self.lightmap_colorspace).tobytes()
 
-            lightmap_size = int(len(lightmap))
-            if lightmap_size != self.lightmap_size:
-                Ui.error("bad file " + file_name + ", must be a " + self.lightmap_resolution + " picture, found " + str(lightmap_size) + ", expected " + str(self.lightmap_size))
+        # image decoding releases the GIL
+        with futures.ThreadPoolExecutor() as executor:
+            self.lightmap_list = list(executor.map(self.readLightmapFile, file_list))
+
+    def readLightmapFile(self, file_name):
+        debug("loading lightmap: " + file_name)
+        image = Image.open(file_name)
+        lightmap = image.convert(self.lightmap_colorspace).tobytes()
 
-            self.lightmap_list.append(lightmap)
+        lightmap_size = int(len(lightmap))
+        if lightmap_size != self.lightmap_size:
+            Ui.error("bad file " + file_name + ", must be a " + self.lightmap_resolution + " picture, found " + str(lightmap_size) + ", expected " + str(self.lightmap_size))
+
+        return lightmap
 
     def writeDir(self, dir_name):
         if not os.path.exists(dir_name):
             os.makedirs(dir_name, exist_ok=True)
 
-        for i in range(0, len(self.lightmap_list)):
-            file_name = "lm_" + str(i).zfill(4) + os.path.extsep + "tga"
-
-            # TODO: os independent:
-            file_path = dir_name + os.path.sep + file_name
-            # TODO: check
-            lightmap_file = open(file_path, "wb")
-
-            # 1: Identification field length (see later for my arbitrary 18 chars string, here 18, up to 255)
-            # 1: No color map
-            # 1: Type 2 (RGB)
-            # 5: Color map spec (ignored)
-            header = b'\x12\0\x02\0\0\0\0\0'
-            # 2: Origin X
-            # 2: Origin Y
-            header += b'\0\0\0\0'
-            # 2: Width
-            # 2: Height
-            header += self.lightmap_width.to_bytes(2, "little")
-            header += self.lightmap_height.to_bytes(2, "little")
-            # 1: Bits per pixels (24)
-            header += (self.lightmap_depth * 8).to_bytes(1, "little")
-            # 1: Attribute bits (0 for 24)
-            header += b'\0'
-            header += b'Granger loves you\0'
-
-            raw = self.lightmap_list[i]
-
-            data = b''
-            # Last line is first line
-            for j in range(0, self.lightmap_size, self.lightmap_line_size):
-                line = raw[self.lightmap_size - self.lightmap_line_size - j : self.lightmap_size - j]
-
-                # RGB → BGR
-                for k in range(0, self.lightmap_line_size, self.lightmap_depth):
-                    data += line[k : k + self.lightmap_depth][::-1]
-
-            debug("header length: " + str(len(header)))
-            debug("data length: " + str(len(data)))
-
-            blob = header + data
-
-            lightmap_file.write(blob)
-            lightmap_file.close()
+        # NumPy and file writes release the GIL
+        with futures.ThreadPoolExecutor() as executor:
+            list(executor.map(lambda i: self.writeLightmapFile(dir_name, i), range(0, len(self.lightmap_list))))
+
+    def writeLightmapFile(self, dir_name, i):
+        file_name = "lm_" + str(i).zfill(4) + os.path.extsep + "tga"
+
+        # TODO: os independent:
+        file_path = dir_name + os.path.sep + file_name
+        # TODO: check
+        lightmap_file = open(file_path, "wb")
+
+        # 1: Identification field length (see later for my arbitrary 18 chars string, here 18, up to 255)
+        # 1: No color map
+        # 1: Type 2 (RGB)
+        # 5: Color map spec (ignored)
+        header = b'\x12\0\x02\0\0\0\0\0'
+        # 2: Origin X
+        # 2: Origin Y
+        header += b'\0\0\0\0'
+        # 2: Width
+        # 2: Height
+        header += self.lightmap_width.to_bytes(2, "little")
+        header += self.lightmap_height.to_bytes(2, "little")
+        # 1: Bits per pixels (24)
+        header += (self.lightmap_depth * 8).to_bytes(1, "little")
+        # 1: Attribute bits (0 for 24)
+        header += b'\0'
+        header += b'Granger loves you\0'
+
+        raw = np.frombuffer(self.lightmap_list[i], dtype=np.uint8)
+        pixels = raw.reshape(self.lightmap_height, self.lightmap_width, self.lightmap_depth)
+
+        # Last line is first line
+        # RGB → BGR
+        data = pixels[::-1, :, ::-1].tobytes()
+
+        debug("header length: " + str(len(header)))
+        debug("data length: " + str(len(data)))
+
+        lightmap_file.write(header)
+        lightmap_file.write(data)
+        lightmap_file.close()
 
     def writeBspDirLump(self, dir_name, lump_name):
         self.writeDir(dir_name + os.path.sep + lump_name + os.path.extsep + "d")
@@ -381,17 +508,322 @@ class QFLightmaps(Q3Lightmaps):
     lightmap_resolution = str(lightmap_width) + "x" + str(lightmap_height) + "x" + str(lightmap_depth)
 
 
+# see http://www.mralligator.com/q3/
+# and q3map2 bspfile_abstract.c for the Raven variants
+# used by RBSP and FBSP (up to 4 lightmap styles)
+
+class Q3Planes(RecordBlob):
+    record_dtype = np.dtype([
+        ("normal", "<f4", (3,)),
+        ("dist", "<f4"),
+    ])
+
+
+class Q3Nodes(RecordBlob):
+    # negative children are leafs: -(leaf + 1)
+    record_dtype = np.dtype([
+        ("plane", "<i4"),
+        ("children", "<i4", (2,)),
+        ("mins", "<i4", (3,)),
+        ("maxs", "<i4", (3,)),
+    ])
+
+
+class Q3Leafs(RecordBlob):
+    record_dtype = np.dtype([
+        ("cluster", "<i4"),
+        ("area", "<i4"),
+        ("mins", "<i4", (3,)),
+        ("maxs", "<i4", (3,)),
+        ("leafface", "<i4"),
+        ("n_leaffaces", "<i4"),
+        ("leafbrush", "<i4"),
+        ("n_leafbrushes", "<i4"),
+    ])
+
+
+class Q3LeafFaces(RecordBlob):
+    record_dtype = np.dtype([
+        ("face", "<i4"),
+    ])
+
+
+class Q3LeafBrushes(RecordBlob):
+    record_dtype = np.dtype([
+        ("brush", "<i4"),
+    ])
+
+
+class Q3Models(RecordBlob):
+    record_dtype = np.dtype([
+        ("mins", "<f4", (3,)),
+        ("maxs", "<f4", (3,)),
+        ("face", "<i4"),
+        ("n_faces", "<i4"),
+        ("brush", "<i4"),
+        ("n_brushes", "<i4"),
+    ])
+
+
+class Q3Brushes(RecordBlob):
+    record_dtype = np.dtype([
+        ("brushside", "<i4"),
+        ("n_brushsides", "<i4"),
+        ("texture", "<i4"),
+    ])
+
+
+class Q3BrushSides(RecordBlob):
+    record_dtype = np.dtype([
+        ("plane", "<i4"),
+        ("texture", "<i4"),
+    ])
+
+
+class JABrushSides(RecordBlob):
+    record_dtype = np.dtype([
+        ("plane", "<i4"),
+        ("texture", "<i4"),
+        ("face", "<i4"),
+    ])
+
+
+class Q3Vertexes(RecordBlob):
+    record_dtype = np.dtype([
+        ("position", "<f4", (3,)),
+        ("texcoord", "<f4", (2,)),
+        ("lm_texcoord", "<f4", (2,)),
+        ("normal", "<f4", (3,)),
+        ("color", "u1", (4,)),
+    ])
+
+
+class JAVertexes(RecordBlob):
+    record_dtype = np.dtype([
+        ("position", "<f4", (3,)),
+        ("texcoord", "<f4", (2,)),
+        ("lm_texcoord", "<f4", (4, 2)),
+        ("normal", "<f4", (3,)),
+        ("color", "u1", (4, 4)),
+    ])
+
+
+class Q3MeshVerts(RecordBlob):
+    record_dtype = np.dtype([
+        ("offset", "<i4"),
+    ])
+
+
+class Q3Effects(RecordBlob):
+    record_dtype = np.dtype([
+        ("name", "S64"),
+        ("brush", "<i4"),
+        ("visible_side", "<i4"),
+    ])
+
+
+class Q3Faces(RecordBlob):
+    # type: 1 polygon, 2 patch, 3 mesh, 4 billboard
+    record_dtype = np.dtype([
+        ("texture", "<i4"),
+        ("effect", "<i4"),
+        ("type", "<i4"),
+        ("vertex", "<i4"),
+        ("n_vertexes", "<i4"),
+        ("meshvert", "<i4"),
+        ("n_meshverts", "<i4"),
+        ("lm_index", "<i4"),
+        ("lm_start", "<i4", (2,)),
+        ("lm_size", "<i4", (2,)),
+        ("lm_origin", "<f4", (3,)),
+        ("lm_vecs", "<f4", (2, 3)),
+        ("normal", "<f4", (3,)),
+        ("size", "<i4", (2,)),
+    ])
+
+
+class JAFaces(RecordBlob):
+    # lm_start is [x, y][style], as Raven stores all x then all y
+    record_dtype = np.dtype([
+        ("texture", "<i4"),
+        ("effect", "<i4"),
+        ("type", "<i4"),
+        ("vertex", "<i4"),
+        ("n_vertexes", "<i4"),
+        ("meshvert", "<i4"),
+        ("n_meshverts", "<i4"),
+        ("lm_styles", "u1", (4,)),
+        ("vertex_styles", "u1", (4,)),
+        ("lm_index", "<i4", (4,)),
+        ("lm_start", "<i4", (2, 4)),
+        ("lm_size", "<i4", (2,)),
+        ("lm_origin", "<f4", (3,)),
+        ("lm_vecs", "<f4", (2, 3)),
+        ("normal", "<f4", (3,)),
+        ("size", "<i4", (2,)),
+    ])
+
+
+class Q3LightVols(RecordBlob):
+    record_dtype = np.dtype([
+        ("ambient", "u1", (3,)),
+        ("directional", "u1", (3,)),
+        ("dir", "u1", (2,)),
+    ])
+
+
+class JALightVols(RecordBlob):
+    record_dtype = np.dtype([
+        ("ambient", "u1", (4, 3)),
+        ("directional", "u1", (4, 3)),
+        ("styles", "u1", (4,)),
+        ("dir", "u1", (2,)),
+    ])
+
+
+class JALightArray(RecordBlob):
+    # one light grid cell index per light grid point
+    record_dtype = np.dtype([
+        ("index", "<u2"),
+    ])
+
+
+class Q3Visdata(Blob):
+    # 4 bytes integer cluster count
+    # 4 bytes integer row size
+    # cluster count × row size bytes, bit B of row A
+    # being set when cluster B is visible from cluster A
+    cluster_count = 0
+    row_size = 0
+    vis_array = None
+
+    def isEmpty(self):
+        return not self.cluster_count
+
+    def importLump(self, blob):
+        self.blob_stream = blob
+
+        if len(blob) < 8:
+            # not vised, everything is visible
+            self.cluster_count, self.row_size = (0, 0)
+            self.vis_array = np.zeros((0, 0), dtype=np.uint8)
+            return
+
+        self.cluster_count, self.row_size = struct.unpack('<ii', blob[:8])
+
+        if len(blob) < 8 + self.cluster_count * self.row_size:
+            raise ValueError("truncated visdata lump: " + str(len(blob)))
+
+        self.vis_array = np.frombuffer(blob, dtype=np.uint8, count=self.cluster_count * self.row_size, offset=8).reshape(self.cluster_count, self.row_size)
+
+    def isClusterVisible(self, from_cluster, to_cluster):
+        # Scalars or arrays of the same shape, negative clusters
+        # (solid or outside the map) never see anything.
+        from_cluster = np.asarray(from_cluster)
+        to_cluster = np.asarray(to_cluster)
+        is_valid = (from_cluster >= 0) & (to_cluster >= 0)
+
+        if not self.cluster_count:
+            return is_valid
+
+        from_cluster = np.where(is_valid, from_cluster, 0)
+        to_cluster = np.where(is_valid, to_cluster, 0)
+        vis_bits = self.vis_array[from_cluster, to_cluster >> 3] >> (to_cluster & 7)
+        return is_valid & (vis_bits & 1 != 0)
+
+    def getVisibleClusters(self, from_cluster):
+        return np.flatnonzero(self.getVisibilityMatrix(from_cluster))
+
+    def getVisibilityMatrix(self, from_cluster=slice(None)):
+        # cluster count × cluster count booleans, one row only
+        # when from_cluster is given
+        vis_bits = np.unpackbits(self.vis_array[from_cluster], axis=-1, bitorder="little")
+        return vis_bits[..., :self.cluster_count].astype(bool)
+
+    def getVisibleClusterCounts(self):
+        # rows are padded (q3map2 rounds them to 64 bits),
+        # mask the padding and count bits without unpacking them
+        cluster_mask = np.packbits(np.arange(self.row_size * 8) < self.cluster_count, bitorder="little")
+        return bit_count_array[self.vis_array & cluster_mask].sum(axis=1)
+
+    def printList(self):
+        print("*** Visdata:")
+        print("clusters: " + str(self.cluster_count))
+        print("row size: " + str(self.row_size))
+        print("")
+        return True
+
+
+class LumpDict(MutableMapping):
+    """Lump blobs by name, the ones still in the BSP file are read on first access."""
+
+    def __init__(self, read_lump=None, pending_lump_name_list=(), blob_dict=None):
+        self.read_lump = read_lump
+        # lumps already read, and not modified
+        self.blob_dict = dict(blob_dict or {})
+        # dicts used as ordered sets
+        self.pending_dict = dict.fromkeys(pending_lump_name_list)
+        self.modified_dict = {}
+
+    def isLoaded(self, lump_name):
+        return lump_name in self.blob_dict
+
+    def isModified(self, lump_name):
+        # set or deleted since read from the BSP file
+        return lump_name in self.modified_dict
+
+    def clearModified(self, lump_name):
+        self.modified_dict.pop(lump_name, None)
+
+    def __getitem__(self, lump_name):
+        if lump_name in self.pending_dict:
+            self.blob_dict[lump_name] = self.read_lump(lump_name)
+            del self.pending_dict[lump_name]
+
+        return self.blob_dict[lump_name]
+
+    def __setitem__(self, lump_name, blob):
+        self.pending_dict.pop(lump_name, None)
+        self.blob_dict[lump_name] = blob
+        self.modified_dict[lump_name] = None
+
+    def __delitem__(self, lump_name):
+        self.modified_dict[lump_name] = None
+
+        if lump_name in self.pending_dict:
+            del self.pending_dict[lump_name]
+        else:
+            del self.blob_dict[lump_name]
+
+    def __contains__(self, lump_name):
+        # do not read the lump just to know it exists
+        return lump_name in self.blob_dict or lump_name in self.pending_dict
+
+    def __iter__(self):
+        yield from list(self.blob_dict)
+        yield from list(self.pending_dict)
+
+    def __len__(self):
+        return len(self.blob_dict) + len(self.pending_dict)
+
+
 class Bsp():
     def __init__(self, bsp_magic_number=None, bsp_version=None):
         self.bsp_file = None
         self.bsp_file_name = None
 
+        # when set, lumps are memoryview slices of this mapping
+        self.bsp_mmap = None
+
         # metadata for printing purpose
         self.lump_directory = {}
+
+        # hashes of lumps in the source file, by (lump name, algorithm)
+        self.lump_hash_dict = {}
         self.sound_list = None
 
         # lumps are stored here
-        self.lump_dict = {}
+        self.lump_dict = LumpDict()
 
         if bsp_magic_number and bsp_version:
             # TODO: make user able to set it with command line option
@@ -405,46 +837,102 @@ class Bsp():
 
         self.bsp_parser_dict = bsp_dict[self.bsp_magic_number][self.bsp_version]
 
-    def readFile(self, bsp_file_name):
+    def readFile(self, bsp_file_name, use_mmap=False):
         # TODO: check
+        # Lumps are read on first access, so the file stays open
+        # (or mapped) until close() is called, unlike what was done
+        # before lumps were loaded lazily.
         self.bsp_file_name = bsp_file_name
-        #self.bsp_file = open(self.bsp_file_name, 'rb')
 
-        # FIXME: check file length
-        read_bsp_magic_number = self.bsp_file.read(4).decode()
-        for bsp_magic_number in bsp_dict.keys():
-            if bsp_magic_number == read_bsp_magic_number:
-                self.bsp_magic_number = bsp_magic_number
-                break
-            else:
-                self.bsp_magic_number = None
+        if not self.bsp_file:
+            self.bsp_file = open(self.bsp_file_name, 'rb')
+
+        if use_mmap:
+            # Lumps will be zero-copy views of the mapping,
+            # the mapping outlives the file object.
+            self.bsp_mmap = mmap.mmap(self.bsp_file.fileno(), 0, access=mmap.ACCESS_READ)
 
-        if not self.bsp_magic_number:
+        self.readHeader()
+        self.lump_hash_dict = {}
+
+        # lumps are only read when first accessed
+        self.lump_dict = LumpDict(self.readLumpBlob, self.bsp_parser_dict["lump_name_list"])
+
+        if self.bsp_mmap:
             self.bsp_file.close()
             self.bsp_file = None
-            Ui.error(": unknown BSP magic number " + str(read_bsp_magic_number))
 
-        self.bsp_file.seek(len(self.bsp_magic_number))
+    def readStream(self, bsp_stream, lump_name_list):
+        """Reads the given lumps from a stream, reading forward only and stopping
+        after the last of them, as seeking back in a compressed zip member
+        restarts decompression from its beginning."""
+        self.bsp_file = bsp_stream
+        self.readHeader()
+        self.bsp_file = None
+        self.lump_hash_dict = {}
+
+        position = 8 + 8 * len(self.bsp_parser_dict["lump_name_list"])
+        blob_dict = {}
+        for lump_name in sorted(lump_name_list, key=lambda lump_name: self.lump_directory[lump_name]["offset"]):
+            offset = self.lump_directory[lump_name]["offset"]
+            length = self.lump_directory[lump_name]["length"]
+
+            if length == 0:
+                blob_dict[lump_name] = b""
+                continue
+
+            if offset < position:
+                raise ValueError("overlapping lump " + lump_name)
 
+            # skip lumps which are not needed
+            while position < offset:
+                skipped = len(bsp_stream.read(min(offset - position, 1 << 20)))
+                if not skipped:
+                    break
+                position += skipped
+
+            blob_dict[lump_name] = bsp_stream.read(length)
+            if len(blob_dict[lump_name]) != length:
+                raise ValueError("truncated lump " + lump_name)
+            position += length
+
+        # only the requested lumps are available, loaded and not modified,
+        # as there is no source file to read the others from
+        self.lump_dict = LumpDict(blob_dict={lump_name: blob_dict[lump_name] for lump_name in self.bsp_parser_dict["lump_name_list"] if lump_name in blob_dict})
+
+    def readHeader(self):
+        # 4 bytes string magic number (IBSP)
+        # 4 bytes integer version
         # FIXME: check file length
-        read_bsp_version = struct.unpack('<I', self.bsp_file.read(4))[0]
-        for bsp_version in bsp_dict[self.bsp_magic_number].keys():
-            if bsp_version == read_bsp_version:
-                self.bsp_version = bsp_version
-                break
+        read_bsp_magic_number, read_bsp_version = struct.unpack('<4sI', self.bsp_file.read(8))
+        read_bsp_magic_number = read_bsp_magic_number.decode()
 
-        if not self.bsp_version:
-            self.bsp_file.close()
-            self.bsp_file = None
-            Ui.error(": unknown BSP version " + str(read_bsp_version))
+        if read_bsp_magic_number not in bsp_dict:
+            self.close()
+            raise ValueError("unknown BSP magic number " + str(read_bsp_magic_number))
 
+        if read_bsp_version not in bsp_dict[read_bsp_magic_number]:
+            self.close()
+            raise ValueError("unknown BSP version " + str(read_bsp_version))
+
+        self.bsp_magic_number = read_bsp_magic_number
+        self.bsp_version = read_bsp_version
         self.bsp_parser_dict = bsp_dict[self.bsp_magic_number][self.bsp_version]
         self.readLumpList()
 
-        for lump_name in self.bsp_parser_dict["lump_name_list"]:
-            self.readLump(lump_name)
+    def close(self):
+        if self.bsp_file:
+            self.bsp_file.close()
+            self.bsp_file = None
 
-        self.bsp_file.close()
+        if self.bsp_mmap:
+            try:
+                self.bsp_mmap.close()
+            except BufferError:
+                # some lump views are still referenced,
+                # the mapping is released with the last of them
+                pass
+            self.bsp_mmap = None
 
     def readDir(self, dir_name):
         # TODO: check if a dir, perhaps argparse can do
@@ -465,30 +953,50 @@ class Bsp():
 
         self.bsp_parser_dict = bsp_dict[self.bsp_magic_number][self.bsp_version]
 
+        # list the bspdir once instead of globbing it once per lump,
+        # a lump file being named like "<lump name>.<anything>"
+        lump_file_dict = {}
+        for file_name in os.listdir(dir_name):
+            lump_name, separator, _ = file_name.partition(os.path.extsep)
+            if separator and lump_name in self.bsp_parser_dict["lump_dict"]:
+                lump_file_dict.setdefault(lump_name, []).append(file_name)
+
+        lump_name_list = []
         for lump_name in self.bsp_parser_dict["lump_name_list"]:
-            file_list = glob.glob(dir_name + os.path.sep + lump_name + os.path.extsep + "*")
+            if lump_name not in lump_file_dict:
+                # TODO: warning?
+                continue
 
-            if len(file_list) > 1:
+            if len(lump_file_dict[lump_name]) > 1:
                 # TODO: handling
                 Ui.error("more than one " + lump_name + " lump in bspdir")
-            if len(file_list) == 0:
-                # TODO: warning?
-                continue
 
-            file_path = file_list[0]
-            file_ext = os.path.splitext(file_path)[-1][1:]
-            file_name = os.path.splitext(os.path.basename(file_path))[0]
+            lump_name_list.append(lump_name)
 
-            lump = self.bsp_parser_dict["lump_dict"][lump_name]()
-            lump.bsp_parser_dict = self.bsp_parser_dict
+        # file reads and image decoding release the GIL
+        with futures.ThreadPoolExecutor() as executor:
+            blob_list = list(executor.map(lambda lump_name: self.readBspDirLumpBlob(os.path.join(dir_name, lump_file_dict[lump_name][0]), lump_name), lump_name_list))
 
-            lump.readBspDirLump(dir_name, lump_name)
-            self.lump_dict[lump_name] = lump.exportLump()
+        for lump_name, blob in zip(lump_name_list, blob_list):
+            self.lump_dict[lump_name] = blob
 
             self.lump_directory[lump_name] = {}
             self.lump_directory[lump_name]["offset"] = None
             self.lump_directory[lump_name]["length"] = None
 
+    def writeBspDirLump(self, dir_name, lump_name, blob):
+        lump = self.bsp_parser_dict["lump_dict"][lump_name]()
+        lump.importLump(blob)
+        if not lump.isEmpty():
+            lump.writeBspDirLump(dir_name, lump_name)
+
+    def readBspDirLumpBlob(self, file_path, lump_name):
+        lump = self.bsp_parser_dict["lump_dict"][lump_name]()
+        lump.bsp_parser_dict = self.bsp_parser_dict
+
+        lump.readBspDirFile(file_path)
+        return lump.exportLump()
+
     def printFileName(self):
         print("*** File:")
         print(self.bsp_file_name)
@@ -517,19 +1025,23 @@ class Bsp():
 
         # TODO: check
 
-        larger_offset = 0
-        ql_advertisements_offset = 0
-        for lump_name in self.bsp_parser_dict["lump_name_list"]:
-            # FIXME: q3 centric
-            # 4 bytes string magic number (IBSP)
-            # 4 bytes integer version
-            # 4 bytes integer lump offset
-            # 4 bytes integer lump size
-            self.bsp_file.seek(8 + (self.bsp_parser_dict["lump_name_list"].index(lump_name) * 8))
+        # FIXME: q3 centric
+        # 4 bytes string magic number (IBSP)
+        # 4 bytes integer version
+        # 4 bytes integer lump offset per lump
+        # 4 bytes integer lump size per lump
+        lump_name_list = self.bsp_parser_dict["lump_name_list"]
+        lump_count = len(lump_name_list)
 
-            self.lump_directory[lump_name] = {}
+        # the directory follows the 8 bytes read by readHeader,
+        # do not seek so that streams can be read forward only
+        directory = struct.unpack('<' + 'II' * lump_count, self.bsp_file.read(lump_count * 8))
 
-            offset, length = struct.unpack('<II', self.bsp_file.read(8))
+        larger_offset = 0
+        ql_advertisements_offset = 0
+        for i in range(0, lump_count):
+            lump_name = lump_name_list[i]
+            offset, length = directory[i * 2 : i * 2 + 2]
 
             # QuakeLive Hack, an extra advertisement lump is added
             # at the end of IBSP 47 but original IBSP 47 (RTCW) does
@@ -552,8 +1064,8 @@ class Bsp():
                     larger_offset = offset
                     ql_advertisements_offset = offset + length
 
+            self.lump_directory[lump_name] = {}
             self.lump_directory[lump_name]["offset"], self.lump_directory[lump_name]["length"] = (offset, length)
-            self.lump_dict[lump_name] = None
 
     def printLumpList(self):
         # TODO: check
@@ -570,28 +1082,184 @@ class Bsp():
         print("")
 
     def readLump(self, lump_name):
-        # TODO: check
+        # the header is read on demand when the caller
+        # only set bsp_file to read some lumps
+        if not self.lump_directory:
+            self.readHeader()
+            self.lump_dict = LumpDict(self.readLumpBlob, self.bsp_parser_dict["lump_name_list"])
 
-        # 4 bytes string magic number (IBSP)
-        # 4 bytes integer version
-        # 4 bytes integer lump offset
-        # 4 bytes integer lump size
-        self.bsp_file.seek(8 + (self.bsp_parser_dict["lump_name_list"].index(lump_name) * 8))
-        offset, length = struct.unpack('<II', self.bsp_file.read(8))
+        # read it now
+        self.lump_dict[lump_name]
+
+    def readLumpBlob(self, lump_name):
+        offset = self.lump_directory[lump_name]["offset"]
+        length = self.lump_directory[lump_name]["length"]
+
+        if self.bsp_mmap:
+            blob = memoryview(self.bsp_mmap)[offset:offset + length]
+        else:
+            self.bsp_file.seek(offset)
+            blob = self.bsp_file.read(length)
+
+        if len(blob) != length:
+            raise ValueError("truncated " + lump_name + " lump in " + str(self.bsp_file_name))
+
+        return blob
+
+
+    def isSourceFile(self, bsp_file_name):
+        if not self.bsp_file and not self.bsp_mmap:
+            return False
+
+        if not self.bsp_file_name or not os.path.isfile(self.bsp_file_name):
+            return False
+
+        return os.path.isfile(bsp_file_name) and os.path.samefile(bsp_file_name, self.bsp_file_name)
+
+    def getLumpLength(self, lump_name):
+        if lump_name not in self.lump_dict:
+            return 0
+
+        if self.lump_dict.isLoaded(lump_name):
+            return len(self.lump_dict[lump_name])
+
+        # untouched lump, known from the directory
+        return self.lump_directory[lump_name]["length"]
+
+    def readLumpChunks(self, lump_name, chunk_size=1 << 20):
+        # Yields an untouched lump from the source file by chunks
+        # instead of loading it, a single view when mapped.
+        offset = self.lump_directory[lump_name]["offset"]
+        length = self.lump_directory[lump_name]["length"]
+
+        if self.bsp_mmap:
+            yield memoryview(self.bsp_mmap)[offset:offset + length]
+            return
 
         self.bsp_file.seek(offset)
-        self.lump_dict[lump_name] = self.bsp_file.read(length)
+        remaining_length = length
+        while remaining_length:
+            chunk = self.bsp_file.read(min(remaining_length, chunk_size))
+            if not chunk:
+                raise ValueError("truncated " + lump_name + " lump in " + str(self.bsp_file_name))
+            yield chunk
+            remaining_length -= len(chunk)
+
+    def copyLump(self, bsp_file, lump_name):
+        if lump_name not in self.lump_dict:
+            return
 
+        if self.lump_dict.isLoaded(lump_name):
+            bsp_file.write(self.lump_dict[lump_name])
+            return
 
-    def writeFile(self, bsp_file_name):
-        bsp_file = open(bsp_file_name, "wb")
+        for chunk in self.readLumpChunks(lump_name):
+            bsp_file.write(chunk)
+
+    def hashLumps(self, algorithm="sha1"):
+        # Returns lump hex digests by lump name. Lumps still in
+        # the source file are streamed from it without being loaded
+        # and their hashes are memoised, loaded lumps are hashed
+        # as they are now.
+        lump_hash_dict = {}
+
+        for lump_name in self.bsp_parser_dict["lump_name_list"]:
+            if lump_name not in self.lump_dict:
+                continue
+
+            if self.lump_dict.isLoaded(lump_name):
+                lump_hash_dict[lump_name] = hashlib.new(algorithm, self.lump_dict[lump_name]).hexdigest()
+                continue
+
+            if (lump_name, algorithm) not in self.lump_hash_dict:
+                lump_hash = hashlib.new(algorithm)
+                for chunk in self.readLumpChunks(lump_name):
+                    lump_hash.update(chunk)
+                self.lump_hash_dict[(lump_name, algorithm)] = lump_hash.hexdigest()
+
+            lump_hash_dict[lump_name] = self.lump_hash_dict[(lump_name, algorithm)]
+
+        return lump_hash_dict
+
+    def patchFile(self, lump_name_list=None):
+        # Rewrites lumps in the source BSP file in place, by default
+        # the modified ones. A lump is written in its old slot when it
+        # fits (up to the next lump, so alignment padding included),
+        # otherwise it is moved to the end of the file. Only lump bytes
+        # and directory entries are written.
+        if lump_name_list is None:
+            lump_name_list = [lump_name for lump_name in self.bsp_parser_dict["lump_name_list"] if self.lump_dict.isModified(lump_name)]
+
+        patch_list = []
+        for lump_name in lump_name_list:
+            blob = self.exportLump(lump_name)
+            old_offset = self.lump_directory[lump_name]["offset"]
+            old_length = self.lump_directory[lump_name]["length"]
+
+            # re-exported but unchanged
+            if len(blob) == old_length and b''.join(self.readLumpChunks(lump_name)) == blob:
+                self.lump_dict.clearModified(lump_name)
+                continue
 
+            patch_list.append((lump_name, blob, old_offset, old_length))
+
+        if not patch_list:
+            return
+
+        bsp_file = open(self.bsp_file_name, "r+b")
+        file_length = bsp_file.seek(0, os.SEEK_END)
+
+        for lump_name, blob, old_offset, old_length in patch_list:
+            lump_length = len(blob)
+
+            # the slot ends where the next non-empty lump starts
+            slot_end = file_length
+            for other_lump_name, other_entry in self.lump_directory.items():
+                if other_lump_name != lump_name and other_entry["length"] and other_entry["offset"] >= old_offset:
+                    slot_end = min(slot_end, other_entry["offset"])
+
+            if lump_length <= slot_end - old_offset:
+                lump_offset = old_offset
+                # also blank what is left of the old lump
+                padded_length = min(slot_end - old_offset, max(old_length + (-old_length % 4), lump_length + (-lump_length % 4)))
+            else:
+                lump_offset = file_length + (-file_length % 4)
+                padded_length = lump_length + (-lump_length % 4)
+                bsp_file.seek(file_length)
+                bsp_file.write(b'\0' * (lump_offset - file_length))
+                file_length = lump_offset + padded_length
+
+            bsp_file.seek(lump_offset)
+            bsp_file.write(blob)
+            bsp_file.write(b'\0' * (padded_length - lump_length))
+
+            bsp_file.seek(8 + self.bsp_parser_dict["lump_name_list"].index(lump_name) * 8)
+            bsp_file.write(struct.pack('<II', lump_offset, lump_length))
+
+            print(str(self.bsp_parser_dict["lump_name_list"].index(lump_name)) + ": " + lump_name + " [" + str(lump_offset) + ", " + str(lump_length) + "]")
+
+            self.lump_directory[lump_name]["offset"] = lump_offset
+            self.lump_directory[lump_name]["length"] = lump_length
+            self.lump_dict.clearModified(lump_name)
+            self.lump_hash_dict = {key: lump_hash for key, lump_hash in self.lump_hash_dict.items() if key[0] != lump_name}
+
+        if self.bsp_mmap and file_length > len(self.bsp_mmap):
+            # moved lumps are past the end of the mapping, map the file again,
+            # lumps already read keep their views of the old mapping
+            bsp_file.flush()
+            old_bsp_mmap = self.bsp_mmap
+            self.bsp_mmap = mmap.mmap(bsp_file.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                old_bsp_mmap.close()
+            except BufferError:
+                pass
+
+        bsp_file.close()
+
+    def writeFile(self, bsp_file_name):
         # Must be a multiple of 4
         metadata_blob = b'Granger loves you!\0\0'
 
-        lumps_blob = b''
-        directory_blob = b''
-
         # FIXME: q3-centric
         # 4 bytes string magic number (IBSP)
         # 4 bytes integer version
@@ -599,7 +1267,8 @@ class Bsp():
         # 4 bytes integer lump size per lump
         # 17 lumps + 1 extra empty lump (Quake Live advertisements)
 
-        lump_count = len(self.bsp_parser_dict["lump_name_list"])
+        lump_name_list = self.bsp_parser_dict["lump_name_list"]
+        lump_count = len(lump_name_list)
         # Hack: if IBSP 46 (Quake 3), add extra empty lump because q3map2 loads
         # advertisements lump from Quake Live even if not there, mistakenly
         # computing lump offset from random data (usually from custom string).
@@ -608,58 +1277,58 @@ class Bsp():
         if self.bsp_magic_number == "IBSP" and self.bsp_version == 46:
             lump_count += 1
 
-        lump_start = 8 + lump_count * 8 + len(metadata_blob)
-        for lump_name in self.bsp_parser_dict["lump_name_list"]:
-            if lump_name in self.lump_dict:
-                lump_content = self.lump_dict[lump_name]
-                lump_length = len(self.lump_dict[lump_name])
-            else:
-                lump_content = b""
-                lump_length = 0
+        # Overwriting the source file: lumps can't be copied from it
+        # (nor be views of it) once it is truncated, load them first.
+        if self.isSourceFile(bsp_file_name):
+            for lump_name in self.lump_dict:
+                self.lump_dict[lump_name] = bytes(self.lump_dict[lump_name])
+            self.close()
 
-            print(str(self.bsp_parser_dict["lump_name_list"].index(lump_name)) + ": " + lump_name + " [" + str(lump_start) + ", " + str(lump_length) + "]")
-            directory_blob += lump_start.to_bytes(4, "little")
-            directory_blob += lump_length.to_bytes(4, "little")
-            lump_start += lump_length
+        # The directory is computed first so lumps
+        # can then be streamed to the file one by one.
+        directory_list = []
+        lump_start = 8 + lump_count * 8 + len(metadata_blob)
+        for lump_name in lump_name_list:
+            lump_length = self.getLumpLength(lump_name)
 
-            lumps_blob += lump_content
+            print(str(lump_name_list.index(lump_name)) + ": " + lump_name + " [" + str(lump_start) + ", " + str(lump_length) + "]")
+            directory_list += [lump_start, lump_length]
 
             # Align lump to 4 bytes if not empty
             # For reference, q3map2 does not count these extra bytes in lump length
             # This happens for entities string for example
-            if lump_length != 0 and lump_length % 4 != 0:
-                for missing_byte in range(0, 4 - (lump_length % 4)):
-                    lumps_blob += b'\0'
-                    lump_start += 1
-                    # silence pylint on unused variable
-                    missing_byte
+            lump_start += lump_length + (-lump_length % 4)
 
         # Hack: see above for more explanations,
         # if IBSP 46 (Quake 3), add extra empty lump because q3map2 loads
         # advertisements lump from Quake Live even if not there.
         if self.bsp_magic_number == "IBSP" and self.bsp_version == 46:
-            directory_blob += lump_start.to_bytes(4, "little") + b"\0\0\0\0"
+            directory_list += [lump_start, 0]
 
-        blob = self.bsp_magic_number.encode()
-        blob += self.bsp_version.to_bytes(4, "little")
-        blob += directory_blob
-        blob += metadata_blob
-        blob += lumps_blob
+        bsp_file = open(bsp_file_name, "wb")
+
+        bsp_file.write(self.bsp_magic_number.encode())
+        bsp_file.write(self.bsp_version.to_bytes(4, "little"))
+        bsp_file.write(struct.pack('<' + 'I' * len(directory_list), *directory_list))
+        bsp_file.write(metadata_blob)
+
+        for lump_name in lump_name_list:
+            self.copyLump(bsp_file, lump_name)
+            bsp_file.write(b'\0' * (-self.getLumpLength(lump_name) % 4))
 
-        bsp_file.write(blob)
         bsp_file.close()
 
     def writeDir(self, dir_name):
         if not os.path.exists(dir_name):
             os.makedirs(dir_name, exist_ok=True)
 
-        for lump_name in self.bsp_parser_dict["lump_name_list"]:
-            lump = self.bsp_parser_dict["lump_dict"][lump_name]()
+        # lumps still in the BSP file are read from this thread,
+        # conversion and file writes release the GIL
+        lump_name_list = [lump_name for lump_name in self.bsp_parser_dict["lump_name_list"] if lump_name in self.lump_dict]
+        blob_list = [self.lump_dict[lump_name] for lump_name in lump_name_list]
 
-            if lump_name in self.lump_dict:
-                lump.importLump(self.lump_dict[lump_name])
-                if not lump.isEmpty():
-                    lump.writeBspDirLump(dir_name, lump_name)
+        with futures.ThreadPoolExecutor() as executor:
+            list(executor.map(lambda lump_name, blob: self.writeBspDirLump(dir_name, lump_name, blob), lump_name_list, blob_list))
 
         bsp_json_dict = {
             "bsp_magic_number": self.bsp_magic_number,
@@ -671,11 +1340,372 @@ class Bsp():
         bsp_description_file.write(json.dumps(bsp_json_dict, sort_keys=True, indent="\t"))
         bsp_description_file.close()
 
+    def getLump(self, lump_name):
+        lump = self.bsp_parser_dict["lump_dict"][lump_name]()
+        lump.bsp_parser_dict = self.bsp_parser_dict
+        lump.importLump(self.exportLump(lump_name))
+        return lump
+
+    def getNodeArrays(self):
+        # node plane normals and distances, and node children
+        node_array = self.getLump("nodes").record_array
+        plane_array = self.getLump("planes").record_array
+
+        node_normal_array = plane_array["normal"][node_array["plane"]].astype(np.float64)
+        node_dist_array = plane_array["dist"][node_array["plane"]].astype(np.float64)
+        return node_normal_array, node_dist_array, node_array["children"]
+
+    def getSurfaceStatistics(self):
+        # Per texture arrays of surface counts by type, triangles
+        # (polygons and meshes), vertexes, patch control points
+        # and lightmaps, plus map totals.
+        face_array = self.getLump("faces").record_array
+        texture_count = len(self.getLump("textures").record_array)
+
+        texture_array = face_array["texture"]
+        type_array = face_array["type"]
+        lightmap_array = face_array["lm_index"]
+        if lightmap_array.ndim == 2:
+            # Raven: first light style
+            lightmap_array = lightmap_array[:, 0]
+
+        def countByTexture(weight_array):
+            return np.bincount(texture_array, weights=weight_array, minlength=texture_count).astype(np.int64)
+
+        is_triangle_soup_array = (type_array == 1) | (type_array == 3)
+        is_lightmapped_array = lightmap_array >= 0
+
+        # distinct (texture, lightmap) pairs
+        texture_lightmap_array = np.unique(np.stack((texture_array[is_lightmapped_array], lightmap_array[is_lightmapped_array])), axis=1)
+
+        return {
+            "polygon_count": countByTexture(type_array == 1),
+            "patch_count": countByTexture(type_array == 2),
+            "mesh_count": countByTexture(type_array == 3),
+            "billboard_count": countByTexture(type_array == 4),
+            "triangle_count": countByTexture(np.where(is_triangle_soup_array, face_array["n_meshverts"] // 3, 0)),
+            "vertex_count": countByTexture(face_array["n_vertexes"]),
+            "patch_control_point_count": countByTexture(np.where(type_array == 2, face_array["size"][:, 0] * face_array["size"][:, 1], 0)),
+            "lightmapped_surface_count": countByTexture(is_lightmapped_array),
+            "lightmap_count": np.bincount(texture_lightmap_array[0], minlength=texture_count),
+            "map_vertex_count": len(self.getLump("vertexes").record_array),
+            "map_meshvert_count": len(self.getLump("meshverts").record_array),
+            "map_lightmap_count": len(np.unique(lightmap_array[is_lightmapped_array])),
+        }
+
+    def getLightGridSize(self):
+        # worldspawn "gridsize" key, like the renderer
+        grid_size_array = np.array([64.0, 64.0, 128.0])
+
+        if "entities" in self.lump_dict:
+            entities = self.getLump("entities")
+            if entities.entity_list and entities.classname_list[0] == b"worldspawn":
+                for key, value in entities.getKeyValueList(0):
+                    if key.lower() == b"gridsize":
+                        grid_size_array = np.array([float(component) for component in value.split()[:3]])
+
+        return grid_size_array
+
+    def getLightGridBounds(self):
+        # Returns grid origin and (nx, ny, nz), the grid covering
+        # the world model bounds as computed by R_LoadLightGrid.
+        grid_size_array = self.getLightGridSize()
+        world_model = self.getLump("models").record_array[0]
+
+        grid_origin_array = grid_size_array * np.ceil(world_model["mins"] / grid_size_array)
+        grid_maxs_array = grid_size_array * np.floor(world_model["maxs"] / grid_size_array)
+        grid_bounds = tuple(int(n) for n in (grid_maxs_array - grid_origin_array) / grid_size_array + 1)
+        return grid_origin_array, grid_bounds
+
+    def getLightGrid(self):
+        # (nx, ny, nz) view of the light grid records, RBSP and FBSP
+        # grid points being indexes into the light grid records
+        grid_bounds = self.getLightGridBounds()[1]
+        grid_point_count = int(np.prod(grid_bounds))
+
+        light_grid_array = self.getLump("lightvols").record_array
+        if "lightarray" in self.bsp_parser_dict["lump_dict"]:
+            light_grid_array = light_grid_array[self.getLump("lightarray").record_array["index"]]
+
+        if len(light_grid_array) != grid_point_count:
+            raise ValueError("light grid mismatch: " + str(len(light_grid_array)) + " points, expected " + str(grid_point_count))
+
+        # x varies fastest
+        return light_grid_array.reshape(grid_bounds[::-1]).transpose(2, 1, 0)
+
+    def getLightGridStatistics(self):
+        # Statistics on the first light style: empty points have
+        # neither ambient nor directional light, brightness is the
+        # ambient + directional luma (0-255) of each point.
+        light_grid_array = self.getLightGrid()
+
+        ambient_array = light_grid_array["ambient"].astype(np.int32)
+        directional_array = light_grid_array["directional"].astype(np.int32)
+        if ambient_array.ndim == 5:
+            # Raven: [style][rgb]
+            ambient_array = ambient_array[..., 0, :]
+            directional_array = directional_array[..., 0, :]
+
+        is_empty_array = ~np.any(ambient_array, axis=-1) & ~np.any(directional_array, axis=-1)
+        luma_array = np.array([0.299, 0.587, 0.114])
+        brightness_array = np.clip(np.rint((ambient_array + directional_array) @ luma_array), 0, 255).astype(np.int64)
+
+        return {
+            "bounds": light_grid_array.shape,
+            "point_count": light_grid_array.size,
+            "empty_point_count": int(is_empty_array.sum()),
+            "mean_ambient": ambient_array.reshape(-1, 3).mean(axis=0) if light_grid_array.size else np.zeros(3),
+            "mean_directional": directional_array.reshape(-1, 3).mean(axis=0) if light_grid_array.size else np.zeros(3),
+            "brightness_histogram": np.bincount(brightness_array.ravel(), minlength=256),
+        }
+
+    def findLeafs(self, point_array):
+        # Returns leaf, cluster and area arrays for an (N, 3) point
+        # array, all points walking down the world tree together,
+        # one level per iteration.
+        point_array = np.asarray(point_array, dtype=np.float64).reshape(-1, 3)
+        leaf_array = self.getLump("leafs").record_array
+        node_normal_array, node_dist_array, node_children_array = self.getNodeArrays()
+
+        # negative node numbers are leafs: -(leaf + 1),
+        # without nodes the whole world is leaf 0
+        if len(node_children_array):
+            node_number_array = np.zeros(len(point_array), dtype=np.int64)
+        else:
+            node_number_array = np.full(len(point_array), -1, dtype=np.int64)
+
+        point_index_array = np.flatnonzero(node_number_array >= 0)
+        while len(point_index_array):
+            node_numbers = node_number_array[point_index_array]
+
+            # same side test as the engine: on the plane is in front
+            dist_array = np.einsum("ij,ij->i", point_array[point_index_array], node_normal_array[node_numbers]) - node_dist_array[node_numbers]
+            child_array = np.where(dist_array >= 0, node_children_array[node_numbers, 0], node_children_array[node_numbers, 1])
+
+            node_number_array[point_index_array] = child_array
+            point_index_array = point_index_array[child_array >= 0]
+
+        leaf_number_array = -(node_number_array + 1)
+        return leaf_number_array, leaf_array["cluster"][leaf_number_array], leaf_array["area"][leaf_number_array]
+
+    def findSegmentBrushes(self, start_array, end_array):
+        # Returns (segment, brush) pairs for brushes in the leafs
+        # crossed by each segment. Segments walk the world tree
+        # together as (segment, node) pairs carrying the [t0, t1]
+        # fraction range of the segment still to trace, a pair being
+        # split at the plane crossing like in CM_TraceThroughTree.
+        surface_clip_epsilon = 0.125
+
+        leaf_array = self.getLump("leafs").record_array
+        leafbrush_array = self.getLump("leafbrushes").record_array["brush"]
+        node_normal_array, node_dist_array, node_children_array = self.getNodeArrays()
+
+        segment_index_array = np.arange(len(start_array))
+        if len(node_children_array):
+            node_number_array = np.zeros(len(start_array), dtype=np.int64)
+        else:
+            node_number_array = np.full(len(start_array), -1, dtype=np.int64)
+        t0_array = np.zeros(len(start_array))
+        t1_array = np.ones(len(start_array))
+        delta_array = end_array - start_array
+
+        leaf_segment_list = []
+        leaf_number_list = []
+        while len(segment_index_array):
+            is_leaf_array = node_number_array < 0
+            leaf_segment_list.append(segment_index_array[is_leaf_array])
+            leaf_number_list.append(-(node_number_array[is_leaf_array] + 1))
+
+            is_node_array = ~is_leaf_array
+            segment_index_array = segment_index_array[is_node_array]
+            node_number_array = node_number_array[is_node_array]
+            t0_array = t0_array[is_node_array]
+            t1_array = t1_array[is_node_array]
+
+            normal_array = node_normal_array[node_number_array]
+            dist_array = node_dist_array[node_number_array]
+            segment_start_array = start_array[segment_index_array]
+            segment_delta_array = delta_array[segment_index_array]
+            start_dist_array = np.einsum("ij,ij->i", segment_start_array + t0_array[:, np.newaxis] * segment_delta_array, normal_array) - dist_array
+            end_dist_array = np.einsum("ij,ij->i", segment_start_array + t1_array[:, np.newaxis] * segment_delta_array, normal_array) - dist_array
+
+            # same margins as CM_TraceThroughTree for point traces
+            is_front_array = (start_dist_array >= 1) & (end_dist_array >= 1)
+            is_back_array = (start_dist_array < -1) & (end_dist_array < -1)
+            is_split_array = ~is_front_array & ~is_back_array
+
+            # the crossing point is put SURFACE_CLIP_EPSILON on the near side,
+            # the near child gets [t0, frac], the far one [frac2, t1]
+            split_start_dist_array = start_dist_array[is_split_array]
+            split_end_dist_array = end_dist_array[is_split_array]
+            with np.errstate(divide="ignore", invalid="ignore"):
+                inverse_dist_array = 1 / (split_start_dist_array - split_end_dist_array)
+            is_start_behind_array = split_start_dist_array < split_end_dist_array
+            is_parallel_array = split_start_dist_array == split_end_dist_array
+            side_array = is_start_behind_array.astype(np.int64)
+            frac2_epsilon_array = np.where(is_start_behind_array, surface_clip_epsilon, -surface_clip_epsilon)
+            with np.errstate(invalid="ignore"):
+                frac_array = np.where(is_parallel_array, 1, np.clip((split_start_dist_array + surface_clip_epsilon) * inverse_dist_array, 0, 1))
+                frac2_array = np.where(is_parallel_array, 0, np.clip((split_start_dist_array + frac2_epsilon_array) * inverse_dist_array, 0, 1))
+
+            split_node_array = node_number_array[is_split_array]
+            split_t0_array = t0_array[is_split_array]
+            split_t1_array = t1_array[is_split_array]
+            split_length_array = split_t1_array - split_t0_array
+            near_t1_array = split_t0_array + frac_array * split_length_array
+            far_t0_array = split_t0_array + frac2_array * split_length_array
+
+            # empty pieces of a segment are dropped, they enter no leaf
+            is_degenerate_array = split_length_array == 0
+            is_near_array = (near_t1_array > split_t0_array) | is_degenerate_array
+            is_far_array = (split_t1_array > far_t0_array) | is_degenerate_array
+
+            split_segment_array = segment_index_array[is_split_array]
+            segment_index_array = np.concatenate((
+                segment_index_array[is_front_array],
+                segment_index_array[is_back_array],
+                split_segment_array[is_near_array],
+                split_segment_array[is_far_array]))
+            node_number_array = np.concatenate((
+                node_children_array[node_number_array[is_front_array], 0],
+                node_children_array[node_number_array[is_back_array], 1],
+                node_children_array[split_node_array[is_near_array], side_array[is_near_array]],
+                node_children_array[split_node_array[is_far_array], 1 - side_array[is_far_array]]))
+            t0_array = np.concatenate((
+                t0_array[is_front_array],
+                t0_array[is_back_array],
+                split_t0_array[is_near_array],
+                far_t0_array[is_far_array]))
+            t1_array = np.concatenate((
+                t1_array[is_front_array],
+                t1_array[is_back_array],
+                near_t1_array[is_near_array],
+                split_t1_array[is_far_array]))
+
+        leaf_segment_array = np.concatenate(leaf_segment_list)
+        leaf_number_array = np.concatenate(leaf_number_list)
+
+        # expand each leaf into its leafbrushes
+        leafbrush_count_array = leaf_array["n_leafbrushes"][leaf_number_array]
+        leafbrush_first_array = np.repeat(leaf_array["leafbrush"][leaf_number_array], leafbrush_count_array)
+        leafbrush_rank_array = np.arange(leafbrush_first_array.size) - np.repeat(np.cumsum(leafbrush_count_array) - leafbrush_count_array, leafbrush_count_array)
+
+        segment_array = np.repeat(leaf_segment_array, leafbrush_count_array)
+        brush_array = leafbrush_array[leafbrush_first_array + leafbrush_rank_array]
+
+        # a brush is referenced by every leaf it touches
+        brush_count = max(len(self.getLump("brushes").record_array), 1)
+        pair_array = np.unique(segment_array.astype(np.int64) * brush_count + brush_array)
+        return pair_array // brush_count, pair_array % brush_count
+
+    def traceSegments(self, start_array, end_array, contents_mask=1, chunk_size=8192):
+        # Clips (N, 3) segments against world brushes whose contents
+        # match contents_mask (default: CONTENTS_SOLID), like a point
+        # CM_BoxTrace. Returns fraction, plane number (-1 when nothing
+        # is hit) and startsolid arrays.
+        # Memory is bounded by chunk_size: segments walk the tree
+        # chunk_size at a time, and (segment, brush) pairs are clipped
+        # chunk_size at a time, as their arrays also scale with the
+        # number of sides of the largest brush.
+        start_array = np.asarray(start_array, dtype=np.float64).reshape(-1, 3)
+        end_array = np.asarray(end_array, dtype=np.float64).reshape(-1, 3)
+
+        brush_array = self.getLump("brushes").record_array
+        brushside_array = self.getLump("brushsides").record_array
+        plane_array = self.getLump("planes").record_array
+        texture_array = self.getLump("textures").record_array
+
+        # brush sides as a padded brush × side plane number table
+        max_side_count = max(brush_array["n_brushsides"].max(initial=0), 1)
+        side_rank_array = np.arange(max_side_count)
+        is_side_array = side_rank_array < brush_array["n_brushsides"][:, np.newaxis]
+        side_number_array = np.where(is_side_array, brush_array["brushside"][:, np.newaxis] + side_rank_array, 0)
+        side_plane_array = np.where(is_side_array, brushside_array["plane"][side_number_array] if len(brushside_array) else 0, -1)
+
+        is_clipping_brush_array = (texture_array["contents"][brush_array["texture"]] & contents_mask) != 0
+
+        plane_normal_array = plane_array["normal"].astype(np.float64)
+        plane_dist_array = plane_array["dist"].astype(np.float64)
+
+        fraction_array = np.ones(len(start_array))
+        plane_number_array = np.full(len(start_array), -1, dtype=np.int64)
+        startsolid_array = np.zeros(len(start_array), dtype=bool)
+
+        for chunk_start in range(0, len(start_array), chunk_size):
+            chunk_slice = slice(chunk_start, chunk_start + chunk_size)
+            chunk_segment_array, chunk_brush_number_array = self.findSegmentBrushes(start_array[chunk_slice], end_array[chunk_slice])
+
+            is_clipping_array = is_clipping_brush_array[chunk_brush_number_array]
+            chunk_segment_array = chunk_segment_array[is_clipping_array] + chunk_start
+            chunk_brush_number_array = chunk_brush_number_array[is_clipping_array]
+
+            for pair_start in range(0, len(chunk_segment_array), chunk_size):
+                pair_slice = slice(pair_start, pair_start + chunk_size)
+                segment_array = chunk_segment_array[pair_slice]
+                brush_number_array = chunk_brush_number_array[pair_slice]
+                self.traceSegmentBrushes(start_array, end_array, segment_array, brush_number_array, side_plane_array, plane_normal_array, plane_dist_array, fraction_array, plane_number_array, startsolid_array)
+
+        return fraction_array, plane_number_array, startsolid_array
+
+    def traceSegmentBrushes(self, start_array, end_array, segment_array, brush_number_array, side_plane_array, plane_normal_array, plane_dist_array, fraction_array, plane_number_array, startsolid_array):
+        # Clips (segment, brush) pairs, updating the result arrays of
+        # traceSegments where a pair is nearer than what was found so far.
+        surface_clip_epsilon = 0.125
+
+        # pair × side distances, padding sides are behind both ends
+        pair_plane_array = side_plane_array[brush_number_array]
+        is_side_array = pair_plane_array >= 0
+        pair_plane_array = np.maximum(pair_plane_array, 0)
+        normal_array = plane_normal_array[pair_plane_array]
+        dist_array = plane_dist_array[pair_plane_array]
+        start_dist_array = np.where(is_side_array, np.einsum("ijk,ik->ij", normal_array, start_array[segment_array]) - dist_array, -1)
+        end_dist_array = np.where(is_side_array, np.einsum("ijk,ik->ij", normal_array, end_array[segment_array]) - dist_array, -1)
+
+        # CM_TraceThroughBrush, one side per column
+        is_missing_array = np.any((start_dist_array > 0) & ((end_dist_array >= surface_clip_epsilon) | (end_dist_array >= start_dist_array)), axis=1)
+        is_startout_array = np.any(start_dist_array > 0, axis=1)
+        is_getout_array = np.any(end_dist_array > 0, axis=1)
+
+        is_crossing_array = (start_dist_array > 0) | (end_dist_array > 0)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            enter_fraction_array = np.where(is_crossing_array & (start_dist_array > end_dist_array), np.maximum((start_dist_array - surface_clip_epsilon) / (start_dist_array - end_dist_array), 0), -1)
+            leave_fraction_array = np.where(is_crossing_array & (start_dist_array <= end_dist_array), np.minimum((start_dist_array + surface_clip_epsilon) / (start_dist_array - end_dist_array), 1), 1)
+
+        clip_side_array = np.argmax(enter_fraction_array, axis=1)
+        enter_fraction_array = enter_fraction_array[np.arange(len(clip_side_array)), clip_side_array]
+        leave_fraction_array = leave_fraction_array.min(axis=1)
+
+        is_hit_array = ~is_missing_array & is_startout_array & (enter_fraction_array < leave_fraction_array) & (enter_fraction_array > -1)
+        is_allsolid_array = ~is_startout_array & ~is_getout_array
+
+        pair_fraction_array = np.where(is_hit_array, np.maximum(enter_fraction_array, 0), 1)
+        pair_fraction_array[is_allsolid_array] = 0
+        pair_plane_number_array = np.where(is_hit_array, pair_plane_array[np.arange(len(clip_side_array)), clip_side_array], -1)
+
+        startsolid_array[segment_array[~is_missing_array & ~is_startout_array]] = True
+
+        # keep the nearest hit of each segment
+        is_nearer_array = is_hit_array | is_allsolid_array
+        segment_array = segment_array[is_nearer_array]
+        pair_fraction_array = pair_fraction_array[is_nearer_array]
+        pair_plane_number_array = pair_plane_number_array[is_nearer_array]
+
+        order_array = np.lexsort((pair_fraction_array, segment_array))
+        is_first_array = np.ones(len(order_array), dtype=bool)
+        is_first_array[1:] = segment_array[order_array][1:] != segment_array[order_array][:-1]
+        nearest_array = order_array[is_first_array]
+
+        # pairs of a segment may span several chunks
+        segment_array = segment_array[nearest_array]
+        is_nearest_array = pair_fraction_array[nearest_array] < fraction_array[segment_array]
+        fraction_array[segment_array[is_nearest_array]] = pair_fraction_array[nearest_array][is_nearest_array]
+        plane_number_array[segment_array[is_nearest_array]] = pair_plane_number_array[nearest_array][is_nearest_array]
+
     def importLump(self, lump_name, blob):
         self.lump_dict[lump_name] = blob
 
     def exportLump(self, lump_name):
-        if lump_name in self.lump_dict.keys():
+        if lump_name in self.lump_dict:
             return self.lump_dict[lump_name]
         else:
             return b""
@@ -683,25 +1713,45 @@ class Bsp():
 
 # must be defined after classes otherwise Python will not find references
 
+# number of bits set in each byte value
+bit_count_array = np.unpackbits(np.arange(256, dtype=np.uint8)[:, np.newaxis], axis=1).sum(axis=1)
+
+# comment, quoted string, unquoted string, brace or stray quote
+q3_entity_token_regex = re.compile(rb'(//[^\n]*)|"([^"]*)"|([^\s{}"]+)|([{}"])')
+
+q3_sound_keyword_list = [
+    "noise",
+    "sound1to2",
+    "sound2to1",
+    "soundPos1",
+    "soundPos2",
+]
+
+q3_file_path_keyword_list = q3_sound_keyword_list + [
+    "model",
+    "model2",
+    "music",
+]
+
 # see http://www.mralligator.com/q3/
 q3_lump_dict = OrderedDict()
 q3_lump_dict["entities"] = Q3Entities
 q3_lump_dict["textures"] = Q3Textures
-q3_lump_dict["planes"] = Blob
-q3_lump_dict["nodes"] = Blob
-q3_lump_dict["leafs"] = Blob
-q3_lump_dict["leaffaces"] = Blob
-q3_lump_dict["leafbrushes"] = Blob
-q3_lump_dict["models"] = Blob
-q3_lump_dict["brushes"] = Blob
-q3_lump_dict["brushsides"] = Blob
-q3_lump_dict["vertexes"] = Blob
-q3_lump_dict["meshverts"] = Blob
-q3_lump_dict["effects"] = Blob
-q3_lump_dict["faces"] = Blob
+q3_lump_dict["planes"] = Q3Planes
+q3_lump_dict["nodes"] = Q3Nodes
+q3_lump_dict["leafs"] = Q3Leafs
+q3_lump_dict["leaffaces"] = Q3LeafFaces
+q3_lump_dict["leafbrushes"] = Q3LeafBrushes
+q3_lump_dict["models"] = Q3Models
+q3_lump_dict["brushes"] = Q3Brushes
+q3_lump_dict["brushsides"] = Q3BrushSides
+q3_lump_dict["vertexes"] = Q3Vertexes
+q3_lump_dict["meshverts"] = Q3MeshVerts
+q3_lump_dict["effects"] = Q3Effects
+q3_lump_dict["faces"] = Q3Faces
 q3_lump_dict["lightmaps"] = Q3Lightmaps
-q3_lump_dict["lightvols"] = Blob
-q3_lump_dict["visdata"] = Blob
+q3_lump_dict["lightvols"] = Q3LightVols
+q3_lump_dict["visdata"] = Q3Visdata
 q3_lump_name_list = list(q3_lump_dict.keys())
 
 ql_lump_dict = q3_lump_dict.copy()
@@ -709,12 +1759,15 @@ ql_lump_dict["advertisements"] = Blob
 ql_lump_name_list = list(ql_lump_dict.keys())
 
 ja_lump_dict = q3_lump_dict.copy()
-ja_lump_dict["lightarray"] = Blob
+ja_lump_dict["brushsides"] = JABrushSides
+ja_lump_dict["vertexes"] = JAVertexes
+ja_lump_dict["faces"] = JAFaces
+ja_lump_dict["lightvols"] = JALightVols
+ja_lump_dict["lightarray"] = JALightArray
 ja_lump_name_list = list(ja_lump_dict.keys())
 
-qf_lump_dict = q3_lump_dict.copy()
+qf_lump_dict = ja_lump_dict.copy()
 qf_lump_dict["lightmaps"] = QFLightmaps
-qf_lump_dict["lightarray"] = Blob
 qf_lump_name_list = list(qf_lump_dict.keys())
 
 fbsp_dict = {
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""Lists which lumps differ between successive revisions of BSP files.
+
+Arguments are either BSP files, each compared to the previous one, or
+directories (e.g. successive builds), in which case every .bsp file is
+compared to the file with the same relative path in the previous directory.
+Lumps are hashed straight from the BSP directory, without being parsed.
+"""
+
+import argparse
+import json
+import os
+import sys
+
+import Bsp
+
+log = lambda *a: print(*a, file=sys.stderr)
+
+def LumpHashes(path, cache):
+    stat = os.stat(path)
+    key = os.path.abspath(path)
+    entry = cache.get(key)
+    if entry and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime_ns:
+        return entry['hashes']
+    bsp = Bsp.Bsp()
+    bsp.readFile(path, use_mmap=True)
+    hashes = bsp.hashLumps()
+    bsp.close()
+    cache[key] = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'hashes': hashes}
+    return hashes
+
+def DiffLumps(old, new):
+    lumps = list(old) + [lump for lump in new if lump not in old]
+    return [lump for lump in lumps if old.get(lump) != new.get(lump)]
+
+def BspFiles(dirname):
+    found = {}
+    for dirpath, _, basenames in os.walk(dirname):
+        for basename in basenames:
+            if basename.lower().endswith('.bsp'):
+                path = os.path.join(dirpath, basename)
+                found[os.path.relpath(path, dirname)] = path
+    return found
+
+def Compare(old, new, cache):
+    differing = DiffLumps(LumpHashes(old, cache), LumpHashes(new, cache))
+    print(old, '->', new)
+    print('\t' + (' '.join(differing) if differing else 'identical'))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-c', type=str, help='JSON file memoising lump hashes by path, size and mtime')
+    parser.add_argument('paths', nargs='+', help='BSP files or directories, oldest first')
+    argv = parser.parse_args()
+
+    cache = {}
+    if argv.c and os.path.isfile(argv.c):
+        with open(argv.c) as f:
+            cache = json.load(f)
+
+    for old, new in zip(argv.paths, argv.paths[1:]):
+        if os.path.isdir(old) and os.path.isdir(new):
+            old_files, new_files = BspFiles(old), BspFiles(new)
+            for relpath in sorted(old_files.keys() - new_files.keys()):
+                print(old_files[relpath], '->', 'removed')
+            for relpath in sorted(new_files):
+                if relpath in old_files:
+                    Compare(old_files[relpath], new_files[relpath], cache)
+                else:
+                    print('added', '->', new_files[relpath])
+        else:
+            Compare(old, new, cache)
+
+    if argv.c:
+        with open(argv.c, 'w') as f:
+            json.dump(cache, f)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""Finds files duplicated in different paks, and how many bytes they waste.
+
+Files are matched by the CRC32 and uncompressed size in the zip central directories,
+so nothing is decompressed unless --verify is given, which decompresses the matched
+files and compares their MD5s. Redundant bytes count every copy but the smallest
+compressed one; groups are sorted by redundant compressed bytes.
+"""
+
+import argparse
+from collections import defaultdict
+import functools
+import hashlib
+import sys
+import zipfile
+import zlib
+import pakscan
+
+log = lambda *a: print(*a, file=sys.stderr)
+
+def HashMembers(keys, pak, z):
+    """Returns {name: md5} for the members of a pak whose (crc, size) is in keys."""
+    hashes = {}
+    for info in z.infolist():
+        if (info.CRC, info.file_size) not in keys:
+            continue
+        md5 = hashlib.md5()
+        try:
+            with z.open(info) as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    md5.update(chunk)
+        except (zipfile.BadZipFile, zlib.error, NotImplementedError) as e:
+            log('Reading', info.filename, 'from', pak, 'failed:', e)
+            continue
+        hashes[info.filename] = md5.hexdigest()
+    return hashes
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-j', type=int, help='worker processes (default: one per CPU)')
+    parser.add_argument('--cache', help='SQLite file caching member lists by path, size and mtime')
+    parser.add_argument('--verify', action='store_true', help='decompress matched files to confirm they are identical')
+    parser.add_argument('paths', nargs='+', help='directories containing paks, or files listing paks')
+    argv = parser.parse_args()
+
+    paks = pakscan.FindPaks(argv.paths)
+    log('Searching', len(paks), 'paks')
+    index = argv.cache and pakscan.PakIndex(argv.cache)
+
+    copies = defaultdict(list)
+    def merge(pak, members):
+        for name, size, compress_size, crc in members:
+            if size and not name.endswith('/'):
+                copies[crc, size].append((pak, name, size, compress_size))
+    pakscan.ScanMembers(paks, merge, argv.j, index)
+    if index:
+        index.Close()
+    groups = {key: group for key, group in copies.items() if len({copy[0] for copy in group}) > 1}
+
+    if argv.verify:
+        hashes = {}
+        def merge(pak, pak_hashes):
+            for name, md5 in pak_hashes.items():
+                hashes[pak, name] = md5
+        candidates = {copy[0] for group in groups.values() for copy in group}
+        candidate_paks = [pak for pak in paks if pak in candidates]
+        log('Verifying', sum(map(len, groups.values())), 'files in', len(candidate_paks), 'paks')
+        pakscan.ScanPaks(candidate_paks, functools.partial(HashMembers, set(groups)), merge, argv.j)
+        verified = defaultdict(list)
+        for group in groups.values():
+            for copy in group:
+                if copy[:2] in hashes:
+                    verified[hashes[copy[:2]]].append(copy)
+        groups = {md5: group for md5, group in verified.items() if len({copy[0] for copy in group}) > 1}
+
+    def Redundant(group):
+        compress_sizes = [compress_size for _, _, _, compress_size in group]
+        return sum(compress_sizes) - min(compress_sizes)
+
+    total_size = total_compressed = 0
+    for group in sorted(groups.values(), key=Redundant, reverse=True):
+        size = group[0][2]
+        redundant = Redundant(group)
+        total_size += size * (len(group) - 1)
+        total_compressed += redundant
+        print('%d copies, %d bytes, %d redundant compressed bytes' % (len(group), size, redundant))
+        for pak, name, _, compress_size in sorted(group):
+            print('\t' + pak, name, compress_size)
+    print('TOTAL %d duplicated files, %d redundant bytes, %d redundant compressed bytes' % (
+        len(groups), total_size, total_compressed))
+
+if __name__ == '__main__':
+    main()
@@ -1,67 +1,233 @@
 #!/usr/bin/env python3
 
+import argparse
 from collections import defaultdict
-import os
+import heapq
+import json
 import re
+import struct
 import sys
+import tempfile
 import zipfile
 import Bsp
+import pakscan
 
 log = lambda *a: print(*a, file=sys.stderr)
 
-paks = []
-for path in sys.argv[1:]:
-    if os.path.isdir(path):
-        for dirname, _, basenames in os.walk(path):
-            for basename in basenames:
-                if basename[-4:].lower() in ('.pk3', '.dpk'):
-                    paks.append(os.path.join(dirname, basename))
-    else:
-        with open(path) as f:
-            for line in f:
-                paks.append(line.strip('\n'))
-log('Searching', len(paks), 'paks')
-
-entdir = defaultdict(list)
-for pak in paks:
-    try:
-        z = zipfile.ZipFile(pak)
-    except (zipfile.BadZipFile, FileNotFoundError):
-        log("Couldn't open", pak)
-        continue
+def ReadEntities(pak, z):
+    """Yields (bsp name, Q3Entities) for the maps of a pak."""
     for name in z.namelist():
         m = re.fullmatch(r'maps/([^/\\]+)[.]bsp', name, re.IGNORECASE)
         if not m:
             continue
-        mapname = m.group(1).partition('_')[0]
         bsp = Bsp.Bsp()
         try:
-            bsp.bsp_file = z.open(name)
+            with z.open(name) as f:
+                # the member is only decompressed up to the end of the entities lump,
+                # which is the first lump in files written by Bsp.writeFile but
+                # comes after the lightmaps and light grid in q3map2 output
+                bsp.readStream(f, ['entities'])
         except zipfile.BadZipFile:
             log('Bad zip file:', pak)
             continue
-        bsp.readLump('entities')
+        except (ValueError, struct.error) as e:
+            log('Reading', name, 'from', pak, 'failed:', e)
+            continue
         lump = bsp.bsp_parser_dict["lump_dict"]["entities"]()
-        wat = bsp.lump_dict["entities"]
+        try:
+            lump.importLump(bsp.lump_dict["entities"])
+        except ValueError as e:
+            log('Parsing entities from', pak, 'failed:', e)
+        yield m.group(1), lump
+
+def ScanEntities(pak, z):
+    """Returns [(classname, (mapname, count, pak, attrs))] for the maps of a pak."""
+    found = []
+    for bspname, lump in ReadEntities(pak, z):
+        mapname = bspname.partition('_')[0]
         ents = defaultdict(int)
         allattrs = defaultdict(set)
-        while len(wat) > 1:
-            m = re.match(rb'\{\n("[^"]*" "[^"]*" *\n)*\}\n*', wat)
-            if not m:
-                log('Parsing entities from', pak, 'failed here:', repr(wat[:200]))
-                break
-            wat = wat[m.end():]
-            attrs = dict(re.findall(rb'"([^"]*)" "([^"]*)"', m.group(0)))
-            if b"classname" in attrs:
-                classname = attrs.pop(b"classname").decode('ascii')
+        for i, entity in enumerate(lump.entity_list):
+            if lump.classname_list[i] is not None:
+                classname = lump.classname_list[i].decode('ascii')
                 ents[classname] += 1
-                allattrs[classname].update(attrs.keys())
+                allattrs[classname].update(keyvalue[0] for keyvalue in entity if keyvalue[0] != b"classname")
             else:
-                log('No classname in entity in', pak, '-', m.group(0))
+                log('No classname in entity in', pak, '-', lump.exportEntity(i))
         for classname, count in ents.items():
-            entdir[classname].append((mapname, count, pak, sorted(k.decode('ascii') for k in allattrs[classname])))
+            found.append((classname, (mapname, count, pak, sorted(k.decode('ascii') for k in allattrs[classname]))))
+    return found
+
+ENTITY_INDEX_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS maps (
+        id INTEGER PRIMARY KEY,
+        pak INTEGER NOT NULL REFERENCES paks(id) ON DELETE CASCADE,
+        name TEXT NOT NULL);
+    CREATE INDEX IF NOT EXISTS maps_pak ON maps(pak);
+    CREATE TABLE IF NOT EXISTS keyvalues (
+        map INTEGER NOT NULL REFERENCES maps(id) ON DELETE CASCADE,
+        entity INTEGER NOT NULL,
+        classname TEXT COLLATE NOCASE,
+        key TEXT NOT NULL COLLATE NOCASE,
+        value TEXT NOT NULL);
+    CREATE INDEX IF NOT EXISTS keyvalues_map ON keyvalues(map);
+    CREATE INDEX IF NOT EXISTS keyvalues_classname ON keyvalues(classname, key);
+    CREATE INDEX IF NOT EXISTS keyvalues_key ON keyvalues(key, value);
+'''
+
+def IndexEntities(pak, z):
+    """Returns (members, [(bsp name, [(entity, classname, key, value)])]) for a pak."""
+    maps = []
+    for bspname, lump in ReadEntities(pak, z):
+        rows = []
+        for i in range(len(lump.entity_list)):
+            classname = lump.classname_list[i]
+            classname = classname and classname.decode('utf8', 'replace')
+            for key, value in lump.getKeyValueList(i):
+                rows.append((i, classname, key.decode('utf8', 'replace'), value.decode('utf8', 'replace')))
+        maps.append((bspname, rows))
+    return pakscan.Members(z), maps
+
+def UpdateEntityIndex(index, paks, jobs):
+    """Indexes the entities of new and changed paks."""
+    index.db.executescript(ENTITY_INDEX_SCHEMA)
+    log('Forgot', index.Prune(), 'deleted paks')
+    keys = index.Unindexed(paks, 'entity index')
+    log(len(paks) - len(keys), 'paks already indexed,', len(keys), 'to index')
+
+    def merge(pak, result):
+        members, maps = result
+        def Insert(pak_id):
+            for bspname, rows in maps:
+                map_id = index.db.execute('INSERT INTO maps (pak, name) VALUES (?, ?)', (pak_id, bspname)).lastrowid
+                index.db.executemany('INSERT INTO keyvalues (map, entity, classname, key, value) VALUES (?, ?, ?, ?, ?)',
+                                     ((map_id,) + row for row in rows))
+            return len(maps)
+        index.IndexPak(pak, keys[pak], members, 'maps', 'entity index', Insert)
+    pakscan.ScanPaks(list(keys), IndexEntities, merge, jobs)
+    index.Commit()
+
+def QueryEntityIndex(index, classname=None, key=None, value=None):
+    """Returns [(classname, bsp name, pak, entity count)] of the entities matching all given criteria."""
+    conditions = []
+    parameters = []
+    for column, parameter in (('classname', classname), ('key', key), ('value', value)):
+        if parameter is not None:
+            conditions.append('keyvalues.' + column + ' = ?')
+            parameters.append(parameter)
+    return index.db.execute('''
+        SELECT keyvalues.classname, maps.name, paks.path, COUNT(DISTINCT keyvalues.entity)
+        FROM keyvalues JOIN maps ON keyvalues.map = maps.id JOIN paks ON maps.pak = paks.id
+        WHERE ''' + (' AND '.join(conditions) or '1') + '''
+        GROUP BY keyvalues.map, keyvalues.classname
+        ORDER BY keyvalues.classname, maps.name, paks.path''', parameters).fetchall()
+
+# occurrences held in memory before being sorted to a temporary file
+RUN_LENGTH = 1 << 18
+
+def WriteRun(run):
+    run.sort()
+    f = tempfile.TemporaryFile('w+')
+    for record in run:
+        f.write(json.dumps(record) + '\n')
+    f.seek(0)
+    run.clear()
+    return f
+
+def ReadRun(f):
+    for line in f:
+        yield json.loads(line)
 
-for classname, occurrences in sorted(entdir.items()):
-    print(classname)
-    for mapname, count, pak, attrs in sorted(occurrences):
+class ExternalSort:
+    """Sorts records with bounded memory, spilling sorted runs to temporary files."""
+
+    def __init__(self, run_length=RUN_LENGTH):
+        self.run_length = run_length
+        self.run = []
+        self.runs = []
+
+    def Add(self, record):
+        self.run.append(record)
+        if len(self.run) >= self.run_length:
+            self.runs.append(WriteRun(self.run))
+
+    def Sorted(self):
+        if not self.runs:
+            yield from sorted(self.run)
+            return
+        self.runs.append(WriteRun(self.run))
+        yield from heapq.merge(*map(ReadRun, self.runs))
+        for f in self.runs:
+            f.close()
+
+def PrintReport(records):
+    """Prints sorted [classname, mapname, count, pak, attrs] records grouped by classname."""
+    last_classname = None
+    for classname, mapname, count, pak, attrs in records:
+        if classname != last_classname:
+            print(classname)
+            last_classname = classname
         print('\t' + mapname, count, pak, *attrs)
+
+def ReadJsonl(f):
+    """Reads the records printed with --jsonl."""
+    for line in f:
+        record = json.loads(line)
+        yield [record['classname'], record['map'], record['count'], record['pak'], record['keys']]
+
+def main():
+    parser = argparse.ArgumentParser(description='Lists which entity classnames and keys are used by which maps.')
+    parser.add_argument('-j', type=int, help='worker processes (default: one per CPU)')
+    parser.add_argument('--cache', help='SQLite file caching per-pak results by path, size and mtime')
+    parser.add_argument('--jsonl', action='store_true', help='print a JSON record per classname per map as soon as each pak is scanned')
+    parser.add_argument('--report', metavar='JSONL', help="print the report from --jsonl output ('-': stdin) instead of scanning paks")
+    parser.add_argument('--index', metavar='DB', help='SQLite entity index to update with the paks, then query')
+    parser.add_argument('--classname', help='query the index for entities with this classname')
+    parser.add_argument('--key', help='query the index for entities with this key')
+    parser.add_argument('--value', help='query the index for entities with this value (of --key if given)')
+    parser.add_argument('paths', nargs='*', help='directories containing paks, or files listing paks')
+    argv = parser.parse_args()
+
+    if argv.index:
+        index = pakscan.PakIndex(argv.index)
+        if argv.paths:
+            UpdateEntityIndex(index, pakscan.FindPaks(argv.paths), argv.j)
+        for classname, bspname, pak, count in QueryEntityIndex(index, argv.classname, argv.key, argv.value):
+            print(classname, bspname, pak, count, sep='\t')
+        index.Close()
+        return
+    if argv.classname or argv.key or argv.value:
+        parser.error('queries need --index')
+
+    if argv.report:
+        records = ExternalSort()
+        with (sys.stdin if argv.report == '-' else open(argv.report)) as f:
+            for record in ReadJsonl(f):
+                records.Add(record)
+        PrintReport(records.Sorted())
+        return
+    if not argv.paths:
+        parser.error('no paks to scan')
+
+    paks = pakscan.FindPaks(argv.paths)
+    log('Searching', len(paks), 'paks')
+    index = argv.cache and pakscan.PakIndex(argv.cache)
+
+    if argv.jsonl:
+        def merge(pak, found):
+            for classname, (mapname, count, pak, attrs) in found:
+                print(json.dumps({'classname': classname, 'map': mapname, 'count': count, 'pak': pak, 'keys': attrs}))
+            sys.stdout.flush()
+        pakscan.ScanPaks(paks, ScanEntities, merge, argv.j, index, 'mapents')
+    else:
+        records = ExternalSort()
+        def merge(pak, found):
+            for classname, occurrence in found:
+                records.Add([classname, *occurrence])
+        pakscan.ScanPaks(paks, ScanEntities, merge, argv.j, index, 'mapents')
+        PrintReport(records.Sorted())
+    if index:
+        index.Close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""Prints per map and per shader surface statistics of the maps found in paks.
+
+For each shader: surfaces by type (polygons, patches, meshes, billboards),
+triangles (polygons and meshes, patches are tessellated at run time), vertexes,
+lightmapped surfaces and distinct lightmaps. Shaders are sorted by triangles.
+"""
+
+import argparse
+import re
+import struct
+import sys
+import zipfile
+import Bsp
+import pakscan
+
+log = lambda *a: print(*a, file=sys.stderr)
+
+COLUMNS = (
+    ('polys', 'polygon_count'),
+    ('patches', 'patch_count'),
+    ('meshes', 'mesh_count'),
+    ('flares', 'billboard_count'),
+    ('tris', 'triangle_count'),
+    ('verts', 'vertex_count'),
+    ('lmsurfs', 'lightmapped_surface_count'),
+    ('lms', 'lightmap_count'),
+)
+ROW_FORMAT = '\t' + ' '.join(['%8s'] * len(COLUMNS)) + '  %s'
+
+def MapStats(pak, z):
+    """Returns the report lines of the maps of a pak."""
+    lines = []
+    for name in z.namelist():
+        m = re.fullmatch(r'maps/([^/\\]+)[.]bsp', name, re.IGNORECASE)
+        if not m:
+            continue
+        bsp = Bsp.Bsp()
+        try:
+            with z.open(name) as f:
+                # the member is only decompressed up to the last of these lumps,
+                # lightmaps, light grid and visdata are usually after them
+                bsp.readStream(f, ['textures', 'vertexes', 'meshverts', 'faces'])
+            stats = bsp.getSurfaceStatistics()
+            textures = bsp.getLump('textures')
+        except zipfile.BadZipFile:
+            log('Bad zip file:', pak)
+            continue
+        except (ValueError, struct.error) as e:
+            log('Reading', name, 'from', pak, 'failed:', e)
+            continue
+
+        lines.append('%s %s' % (m.group(1), pak))
+        lines.append('\t%d vertexes, %d meshverts, %d lightmaps' % (
+            stats['map_vertex_count'], stats['map_meshvert_count'], stats['map_lightmap_count']))
+        lines.append(ROW_FORMAT % (tuple(title for title, _ in COLUMNS) + ('shader',)))
+        used = [i for i in range(len(textures.record_array))
+                if any(stats[key][i] for key in ('polygon_count', 'patch_count', 'mesh_count', 'billboard_count'))]
+        for i in sorted(used, key=lambda i: (-stats['triangle_count'][i], textures.getName(i))):
+            lines.append(ROW_FORMAT % (tuple(stats[key][i] for _, key in COLUMNS) + (textures.getName(i),)))
+        lines.append(ROW_FORMAT % (tuple(stats[key].sum() for _, key in COLUMNS[:-1]) + (stats['map_lightmap_count'], 'TOTAL')))
+    return lines
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-j', type=int, help='worker processes (default: one per CPU)')
+    parser.add_argument('--cache', help='SQLite file caching per-pak results by path, size and mtime')
+    parser.add_argument('paths', nargs='+', help='directories containing paks, or files listing paks')
+    argv = parser.parse_args()
+
+    paks = pakscan.FindPaks(argv.paths)
+    log('Searching', len(paks), 'paks')
+    index = argv.cache and pakscan.PakIndex(argv.cache)
+
+    def merge(pak, lines):
+        for line in lines:
+            print(line)
+    pakscan.ScanPaks(paks, MapStats, merge, argv.j, index, 'mapstats')
+    if index:
+        index.Close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,264 @@
+"""Finds .pk3/.dpk paks and scans them in a process pool.
+
+Scripts provide a scan(pak, zipfile) function returning a per-pak result, which
+runs in worker processes, and a merge(pak, result) function called in the parent
+process as results arrive. Only scan (and its result) must be picklable, e.g. a
+module-level function or a functools.partial of one, and scripts must only start
+scanning under `if __name__ == '__main__'`.
+
+With a PakIndex, member lists and scan results are cached on disk, and only new
+or changed paks (by path, size and mtime) are opened again.
+"""
+
+from concurrent import futures
+import functools
+import os
+import pickle
+import sqlite3
+import sys
+import zipfile
+
+log = lambda *a: print(*a, file=sys.stderr)
+
+def FindPaks(paths):
+    """Directories are searched for paks, other paths are files listing paks."""
+    paks = []
+    for path in paths:
+        if os.path.isdir(path):
+            for dirname, _, basenames in os.walk(path):
+                for basename in basenames:
+                    if basename[-4:].lower() in ('.pk3', '.dpk'):
+                        paks.append(os.path.join(dirname, basename))
+        else:
+            with open(path) as f:
+                for line in f:
+                    paks.append(line.strip('\n'))
+    return paks
+
+class PakIndex:
+    """SQLite cache of pak member lists and per-pak results, keyed by (path, size, mtime).
+
+    Rows of a pak which changed are deleted when it is added again. Other scripts may
+    add their own tables referencing paks(id) ON DELETE CASCADE to get the same behavior.
+    """
+
+    COMMIT_INTERVAL = 100
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.execute('PRAGMA foreign_keys = ON')
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS paks (
+                id INTEGER PRIMARY KEY,
+                path TEXT UNIQUE NOT NULL,
+                size INTEGER NOT NULL,
+                mtime INTEGER NOT NULL);
+            CREATE TABLE IF NOT EXISTS members (
+                pak INTEGER NOT NULL REFERENCES paks(id) ON DELETE CASCADE,
+                name TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                compress_size INTEGER NOT NULL,
+                crc INTEGER NOT NULL);
+            CREATE INDEX IF NOT EXISTS members_pak ON members(pak);
+            CREATE TABLE IF NOT EXISTS results (
+                pak INTEGER NOT NULL REFERENCES paks(id) ON DELETE CASCADE,
+                tag TEXT NOT NULL,
+                data BLOB NOT NULL,
+                PRIMARY KEY (pak, tag));
+        ''')
+        self.uncommitted = 0
+
+    @staticmethod
+    def Key(pak):
+        stat = os.stat(pak)
+        return os.path.abspath(pak), stat.st_size, stat.st_mtime_ns
+
+    def PakId(self, pak, key=None):
+        """Returns the id of the pak if it is indexed and unchanged, else None."""
+        path, size, mtime = key or self.Key(pak)
+        row = self.db.execute('SELECT id, size, mtime FROM paks WHERE path = ?', (path,)).fetchone()
+        if row and row[1:] == (size, mtime):
+            return row[0]
+        return None
+
+    def Add(self, pak, members, key=None):
+        """Indexes a pak with its [(name, size, compress_size, crc)] members, returns its id."""
+        path, size, mtime = key or self.Key(pak)
+        self.db.execute('DELETE FROM paks WHERE path = ?', (path,))
+        pak_id = self.db.execute('INSERT INTO paks (path, size, mtime) VALUES (?, ?, ?)', (path, size, mtime)).lastrowid
+        self.db.executemany('INSERT INTO members (pak, name, size, compress_size, crc) VALUES (?, ?, ?, ?, ?)',
+                            ((pak_id,) + member for member in members))
+        self.Changed()
+        return pak_id
+
+    def Prune(self):
+        """Forgets the paks which no longer exist."""
+        paths = [path for path, in self.db.execute('SELECT path FROM paks') if not os.path.exists(path)]
+        self.db.executemany('DELETE FROM paks WHERE path = ?', ((path,) for path in paths))
+        self.Commit()
+        return len(paths)
+
+    def Unindexed(self, paks, tag):
+        """Returns {pak: key} for the paks which are new, changed or have no result for the tag."""
+        keys = {}
+        for pak in paks:
+            try:
+                key = self.Key(pak)
+            except FileNotFoundError:
+                log("Couldn't open", pak)
+                continue
+            pak_id = self.PakId(pak, key)
+            if pak_id is None or not self.HasResult(pak_id, tag):
+                keys[pak] = key
+        return keys
+
+    def IndexPak(self, pak, key, members, table, tag, insert):
+        """Replaces a pak's rows in table, which references paks(id) in its pak column.
+
+        The pak is added unless it is unchanged, so the results of other tags are kept.
+        insert(pak_id) adds the new rows and returns a count, recorded as the tag's
+        result to mark the pak as indexed."""
+        pak_id = self.PakId(pak, key)
+        if pak_id is None:
+            pak_id = self.Add(pak, members, key)
+        self.db.execute('DELETE FROM ' + table + ' WHERE pak = ?', (pak_id,))
+        self.SetResult(pak_id, tag, insert(pak_id))
+
+    def Members(self, pak_id):
+        return self.db.execute('SELECT name, size, compress_size, crc FROM members WHERE pak = ?', (pak_id,)).fetchall()
+
+    def HasResult(self, pak_id, tag):
+        return self.db.execute('SELECT 1 FROM results WHERE pak = ? AND tag = ?', (pak_id, tag)).fetchone() is not None
+
+    def Result(self, pak_id, tag):
+        """Returns (True, result) if a result is cached for the tag, else (False, None)."""
+        row = self.db.execute('SELECT data FROM results WHERE pak = ? AND tag = ?', (pak_id, tag)).fetchone()
+        if row is None:
+            return False, None
+        return True, pickle.loads(row[0])
+
+    def SetResult(self, pak_id, tag, result):
+        self.db.execute('INSERT OR REPLACE INTO results (pak, tag, data) VALUES (?, ?, ?)',
+                        (pak_id, tag, pickle.dumps(result)))
+        self.Changed()
+
+    def Changed(self):
+        # commit regularly so an interrupted scan is not lost
+        self.uncommitted += 1
+        if self.uncommitted >= self.COMMIT_INTERVAL:
+            self.Commit()
+
+    def Commit(self):
+        self.db.commit()
+        self.uncommitted = 0
+
+    def Close(self):
+        self.Commit()
+        self.db.close()
+
+def Members(z):
+    return [(i.filename, i.file_size, i.compress_size, i.CRC) for i in z.infolist()]
+
+def ScanPak(scan, with_members, pak):
+    try:
+        z = zipfile.ZipFile(pak)
+    except (zipfile.BadZipFile, FileNotFoundError):
+        log("Couldn't open", pak)
+        return None
+    with z:
+        try:
+            result = scan(pak, z)
+        except Exception as e:
+            # one broken pak must not end a scan of thousands
+            log('Scanning', pak, 'failed:', repr(e))
+            return None
+        if with_members:
+            return result, Members(z)
+        return result
+
+def ScanPaks(paks, scan, merge, jobs=None, index=None, tag=None):
+    """Calls scan on each pak, in `jobs` processes (default: one per CPU, 1: no pool),
+    and merge on each non-None result, in pak order. Paks which fail to open or
+    to scan are logged and skipped.
+
+    With a PakIndex, results are cached under `tag` (which should change whenever
+    the result format does), and paks with a cached result are not opened."""
+    keys = {}
+    pak_ids = {}
+    cached = set()
+    todo = paks
+    if index:
+        todo = []
+        for pak in paks:
+            try:
+                keys[pak] = PakIndex.Key(pak)
+            except FileNotFoundError:
+                todo.append(pak)
+                continue
+            pak_ids[pak] = index.PakId(pak, keys[pak])
+            if pak_ids[pak] is not None and index.HasResult(pak_ids[pak], tag):
+                cached.add(pak)
+            else:
+                todo.append(pak)
+        log(len(cached), 'paks cached,', len(todo), 'to scan')
+
+    def MergeResults(results):
+        results = iter(results)
+        for pak in paks:
+            if pak in cached:
+                # unpickled one at a time, so cached results are not all in memory at once
+                _, result = index.Result(pak_ids[pak], tag)
+            else:
+                result = next(results)
+                if index and result is not None:
+                    result, members = result
+                    # re-adding an unchanged pak would drop the results of other tags
+                    if pak_ids[pak] is None:
+                        pak_ids[pak] = index.Add(pak, members, keys[pak])
+                    index.SetResult(pak_ids[pak], tag, result)
+            if result is not None:
+                merge(pak, result)
+        if index:
+            index.Commit()
+
+    scan_pak = functools.partial(ScanPak, scan, index is not None)
+    if jobs == 1:
+        MergeResults(map(scan_pak, todo))
+    else:
+        with futures.ProcessPoolExecutor(jobs) as executor:
+            # batches keep IPC overhead low with many small paks
+            MergeResults(executor.map(scan_pak, todo, chunksize=8))
+
+def ListMembers(pak, z):
+    return Members(z)
+
+def ScanMembers(paks, merge, jobs=None, index=None):
+    """Calls merge(pak, [(name, size, compress_size, crc)]) for each pak,
+    the paks which are already indexed first.
+
+    With a PakIndex, the member lists of unchanged paks are read from it
+    rather than from the paks, and the others are added to it."""
+    keys = {}
+    todo = paks
+    if index:
+        todo = []
+        for pak in paks:
+            try:
+                keys[pak] = PakIndex.Key(pak)
+            except FileNotFoundError:
+                todo.append(pak)
+                continue
+            pak_id = index.PakId(pak, keys[pak])
+            if pak_id is None:
+                todo.append(pak)
+            else:
+                merge(pak, index.Members(pak_id))
+        log(len(paks) - len(todo), 'paks indexed,', len(todo), 'to scan')
+
+    def MergeMembers(pak, members):
+        if pak in keys:
+            index.Add(pak, members, keys[pak])
+        merge(pak, members)
+    ScanPaks(todo, ListMembers, MergeMembers, jobs)
+    if index:
+        index.Commit()
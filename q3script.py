@@ -0,0 +1,80 @@
+"""Tokenizer for idTech3 text scripts: shaders, particles, trails...
+
+Scripts are words, "quoted strings" and { } blocks, with // and /* */ comments.
+Text is tokenized in a single regex pass over the bytes, tracking brace depth.
+"""
+
+import re
+import sys
+
+WORD = 'word'
+STRING = 'string'
+OPEN = 'open'
+CLOSE = 'close'
+
+token_regex = re.compile(rb'''
+      //[^\n]*
+    | /[*] .*? (?: [*]/ | \Z )
+    | "(?P<string> [^"]* )"?
+    | (?P<open> [{] )
+    | (?P<close> [}] )
+    | (?P<word> [^\s{}"]+ )
+''', re.VERBOSE | re.DOTALL)
+
+# identifiers, as opposed to numbers, paths, $variables...
+keyword_regex = re.compile(rb'[a-zA-Z]\w+')
+
+class Tokenizer:
+    """Tokenizes scripts, one Tokenizer may be used for many files.
+
+    After Tokenize, depth is the number of unclosed braces and
+    unexpected_brace_count the number of closing braces that had no opening one.
+    """
+
+    def __init__(self):
+        # keyword (or None) by word, so each distinct word is only lowercased once
+        self.keyword_dict = {}
+        self.depth = 0
+        self.unexpected_brace_count = 0
+
+    def Tokenize(self, text):
+        """Yields (kind, token, depth, start, end) for the tokens of text (bytes).
+
+        Braces are at the depth outside of their block, strings are unquoted."""
+        self.depth = 0
+        self.unexpected_brace_count = 0
+        for m in token_regex.finditer(text):
+            kind = m.lastgroup
+            if kind is None:
+                # comment
+                continue
+            if kind == OPEN:
+                yield kind, b'{', self.depth, m.start(), m.end()
+                self.depth += 1
+            elif kind == CLOSE:
+                if self.depth:
+                    self.depth -= 1
+                    yield kind, b'}', self.depth, m.start(), m.end()
+                else:
+                    self.unexpected_brace_count += 1
+            else:
+                yield kind, m.group(kind), self.depth, m.start(), m.end()
+
+    def Keyword(self, word):
+        """Returns the interned lowercase keyword for a word, or None if it is not an identifier."""
+        try:
+            return self.keyword_dict[word]
+        except KeyError:
+            keyword = None
+            if keyword_regex.fullmatch(word):
+                keyword = sys.intern(word.lower().decode('ascii'))
+            self.keyword_dict[word] = keyword
+            return keyword
+
+    def Keywords(self, text):
+        """Yields the keywords of the words inside blocks."""
+        for kind, token, depth, _, _ in self.Tokenize(text):
+            if depth and kind == WORD:
+                keyword = self.Keyword(token)
+                if keyword:
+                    yield keyword
@@ -1,46 +1,34 @@
 #!/usr/bin/env python3
 """Makes a directory of which shader/particle/trail keywords are used by which files.
 
-Note: the "parser" is very simplistic. It detects some things as keywords which aren't,
-such as single-word shader names referenced in particle files.
+Keywords are the identifiers found inside blocks. Note: this detects some things
+as keywords which aren't, such as single-word shader names referenced in particle files.
 """
 
-from collections import defaultdict
+import argparse
+from collections import Counter, defaultdict
+import functools
 import os
 import re
 import sys
 import zipfile
+import pakscan
+import q3script
 
 log = lambda *a: print(*a, file=sys.stderr)
 
-thing = sys.argv[1]
-assert thing in ('shader', 'particle', 'trail')
+THINGS = ('shader', 'particle', 'trail')
 
-paks = []
-for path in sys.argv[2:]:
-    if os.path.isdir(path):
-        for dirname, _, basenames in os.walk(path):
-            for basename in basenames:
-                if basename[-4:].lower() in ('.pk3', '.dpk'):
-                    paks.append(os.path.join(dirname, basename))
-    else:
-        with open(path) as f:
-            for line in f:
-                paks.append(line.strip('\n'))
-log('Searching', len(paks), 'paks')
-
-kwdir = defaultdict(list)
-
-for pak in paks:
-    try:
-        z = zipfile.ZipFile(pak)
-    except (zipfile.BadZipFile, FileNotFoundError):
-        log("Couldn't open", pak)
-        continue
+def ScanKeywords(things, pak, z):
+    """Returns [(thing, kw, (pak, script, count))] for the scripts of a pak."""
+    found = []
+    tokenizer = q3script.Tokenizer()
+    script_regex = re.compile(r'scripts/.*[.](' + '|'.join(things) + ')', re.IGNORECASE)
     for name in z.namelist():
-        m = re.fullmatch(r'scripts/.*[.]' + thing, name, re.IGNORECASE)
+        m = script_regex.fullmatch(name)
         if not m:
             continue
+        thing = m.group(1).lower()
         try:
             f = z.open(name)
             text = f.read()
@@ -48,25 +36,53 @@ for pak in paks:
         except zipfile.BadZipFile:
             log('Bad zip file:', pak)
             continue
-        text = re.sub(rb'//.*|/[*][.\n]*[*]/', b'', text)
-        kws = defaultdict(int)
-        blevel = 0
-        for token in re.findall(rb'[{}]|[^\s{}]+[/\\][^\s{}]+|[a-zA-Z]\w*', text):
-            if token == b'{':
-                blevel += 1
-            elif token == b'}':
-                if blevel == 0:
-                    log('Unexpected closing brace', pak, name)
-                else:
-                    blevel -= 1
-            elif blevel and len(token) > 1 and b'/' not in token and b'\\' not in token:
-                kws[token.lower().decode('utf8')] += 1
-        if blevel != 0:
+        counts = Counter(tokenizer.Keywords(text))
+        if tokenizer.unexpected_brace_count:
+            log('Unexpected closing brace', pak, name)
+        if tokenizer.depth:
             log('Unclosed brace', pak, name)
-        for kw, count in kws.items():
-            kwdir[kw].append((pak, name, count))
+        for kw, count in counts.items():
+            found.append((thing, kw, (pak, name, count)))
+    return found
+
+def PrintReport(kwdir, file=None):
+    for kw, occurrences in sorted(kwdir.items()):
+        print(kw, file=file)
+        for pak, script, count in sorted(occurrences):
+            print('\t' + pak, script, count, file=file)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-j', type=int, help='worker processes (default: one per CPU)')
+    parser.add_argument('--cache', help='SQLite file caching per-pak results by path, size and mtime')
+    parser.add_argument('-o', metavar='DIR', help='write each report to DIR/<thing>.txt instead of stdout')
+    parser.add_argument('thing', choices=THINGS + ('all',), help='all: scan every kind of script in one pass (needs -o)')
+    parser.add_argument('paths', nargs='+', help='directories containing paks, or files listing paks')
+    argv = parser.parse_args()
+
+    things = THINGS if argv.thing == 'all' else (argv.thing,)
+    if len(things) > 1 and not argv.o:
+        parser.error('-o is needed to write several reports')
+
+    paks = pakscan.FindPaks(argv.paths)
+    log('Searching', len(paks), 'paks')
+    index = argv.cache and pakscan.PakIndex(argv.cache)
+
+    kwdirs = {thing: defaultdict(list) for thing in things}
+    def merge(pak, found):
+        for thing, kw, occurrence in found:
+            kwdirs[thing][kw].append(occurrence)
+    pakscan.ScanPaks(paks, functools.partial(ScanKeywords, things), merge, argv.j, index, 'keywords ' + argv.thing)
+    if index:
+        index.Close()
+
+    if not argv.o:
+        PrintReport(kwdirs[argv.thing])
+        return
+    os.makedirs(argv.o, exist_ok=True)
+    for thing, kwdir in kwdirs.items():
+        with open(os.path.join(argv.o, thing + '.txt'), 'w') as f:
+            PrintReport(kwdir, f)
 
-for kw, occurrences in sorted(kwdir.items()):
-    print(kw)
-    for pak, script, count in sorted(occurrences):
-        print('\t' + pak, script, count)
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+"""Indexes where shaders are defined in the scripts/*.shader files of paks.
+
+The index is an SQLite file mapping each shader name to the pak, script, byte offset
+and length of its definition(s). Paks are only scanned again when they change.
+
+When a shader is defined several times, the definition which wins is the one the
+engine loads: a script in a pak is overridden by the script of the same name in a
+later pak (paks being sorted by name), later scripts (sorted by name) override
+earlier ones, and in a script the first definition wins.
+"""
+
+import argparse
+import os
+import re
+import sys
+import zipfile
+import pakscan
+import q3script
+
+log = lambda *a: print(*a, file=sys.stderr)
+
+SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS scripts (
+        id INTEGER PRIMARY KEY,
+        pak INTEGER NOT NULL REFERENCES paks(id) ON DELETE CASCADE,
+        name TEXT NOT NULL COLLATE NOCASE);
+    CREATE INDEX IF NOT EXISTS scripts_pak ON scripts(pak);
+    CREATE TABLE IF NOT EXISTS shaders (
+        script INTEGER NOT NULL REFERENCES scripts(id) ON DELETE CASCADE,
+        name TEXT NOT NULL COLLATE NOCASE,
+        offset INTEGER NOT NULL,
+        length INTEGER NOT NULL);
+    CREATE INDEX IF NOT EXISTS shaders_script ON shaders(script);
+    CREATE INDEX IF NOT EXISTS shaders_name ON shaders(name);
+'''
+
+def FindShaders(tokenizer, text):
+    """Returns [(name, offset, length)] of the shaders defined in a script, from name to closing brace."""
+    shaders = []
+    name = block_name = None
+    for kind, token, depth, start, end in tokenizer.Tokenize(text):
+        if depth:
+            continue
+        if kind in (q3script.WORD, q3script.STRING):
+            name, name_start = token, start
+        elif kind == q3script.OPEN:
+            block_name = name
+            name = None
+        elif kind == q3script.CLOSE and block_name is not None:
+            shaders.append((block_name.decode('utf8', 'replace'), name_start, end - name_start))
+            block_name = None
+    return shaders
+
+def ScanShaders(pak, z):
+    """Returns (members, [(script, [(name, offset, length)])]) for a pak."""
+    scripts = []
+    tokenizer = q3script.Tokenizer()
+    for name in z.namelist():
+        if not re.fullmatch(r'scripts/.*[.]shader', name, re.IGNORECASE):
+            continue
+        try:
+            with z.open(name) as f:
+                text = f.read()
+        except zipfile.BadZipFile:
+            log('Bad zip file:', pak)
+            continue
+        scripts.append((name, FindShaders(tokenizer, text)))
+        if tokenizer.depth or tokenizer.unexpected_brace_count:
+            log('Unbalanced braces', pak, name)
+    return pakscan.Members(z), scripts
+
+def UpdateIndex(index, paks, jobs):
+    """Indexes the shaders of new and changed paks."""
+    index.db.executescript(SCHEMA)
+    log('Forgot', index.Prune(), 'deleted paks')
+    keys = index.Unindexed(paks, 'shader index')
+    log(len(paks) - len(keys), 'paks already indexed,', len(keys), 'to index')
+
+    def merge(pak, result):
+        members, scripts = result
+        def Insert(pak_id):
+            for script, shaders in scripts:
+                script_id = index.db.execute('INSERT INTO scripts (pak, name) VALUES (?, ?)', (pak_id, script)).lastrowid
+                index.db.executemany('INSERT INTO shaders (script, name, offset, length) VALUES (?, ?, ?, ?)',
+                                     ((script_id,) + shader for shader in shaders))
+            return len(scripts)
+        index.IndexPak(pak, keys[pak], members, 'scripts', 'shader index', Insert)
+    pakscan.ScanPaks(list(keys), ScanShaders, merge, jobs)
+    index.Commit()
+
+def Definitions(index, name):
+    """Returns the [(pak, script, offset, length)] definitions of a shader, the winning one last."""
+    definitions = index.db.execute('''
+        SELECT paks.path, scripts.name, shaders.offset, shaders.length
+        FROM shaders JOIN scripts ON shaders.script = scripts.id JOIN paks ON scripts.pak = paks.id
+        WHERE shaders.name = ?''', (name,)).fetchall()
+    # the last pak by name containing each script is the one loaded
+    loaded_paks = {}
+    for pak, script in index.db.execute('''
+            SELECT paks.path, scripts.name
+            FROM scripts JOIN paks ON scripts.pak = paks.id
+            WHERE scripts.name IN (SELECT scripts.name FROM shaders JOIN scripts ON shaders.script = scripts.id
+                                   WHERE shaders.name = ?)''', (name,)).fetchall():
+        key = script.lower()
+        loaded_paks[key] = max(loaded_paks.get(key, pak), pak, key=os.path.basename)
+    def Priority(definition):
+        pak, script, offset, _ = definition
+        return loaded_paks[script.lower()] == pak, script.lower(), -offset
+    return sorted(definitions, key=Priority)
+
+def ReadDefinition(pak, script, offset, length):
+    with zipfile.ZipFile(pak) as z, z.open(script) as f:
+        # stored scripts seek directly, compressed ones are decompressed up to the offset
+        f.seek(offset)
+        return f.read(length)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-j', type=int, help='worker processes (default: one per CPU)')
+    parser.add_argument('--show', metavar='NAME', help='print the definitions of a shader, then the text of the winning one')
+    parser.add_argument('--duplicates', action='store_true', help='list the shaders defined more than once, and which definition wins')
+    parser.add_argument('index', help='SQLite index file')
+    parser.add_argument('paths', nargs='*', help='directories containing paks, or files listing paks, to (re)index')
+    argv = parser.parse_args()
+
+    index = pakscan.PakIndex(argv.index)
+    index.db.executescript(SCHEMA)
+    if argv.paths:
+        UpdateIndex(index, pakscan.FindPaks(argv.paths), argv.j)
+
+    if argv.duplicates:
+        for name, in index.db.execute('SELECT name FROM shaders GROUP BY name HAVING COUNT(*) > 1 ORDER BY name').fetchall():
+            *overridden, winner = Definitions(index, name)
+            print(name)
+            print('\tWINS', *winner)
+            for pak, script, offset, length in reversed(overridden):
+                print('\t' + pak, script, offset, length)
+
+    if argv.show:
+        definitions = Definitions(index, argv.show)
+        if not definitions:
+            log('No definition of', argv.show)
+        for definition in definitions:
+            log(*definition)
+        if definitions:
+            print(ReadDefinition(*definitions[-1]).decode('utf8', 'replace'))
+    index.Close()
+
+if __name__ == '__main__':
+    main()
@@ -1,41 +1,149 @@
 #!/usr/bin/env python3
+"""Finds identical paks.
 
+Paks are grouped by size, then by a hash of their first and last blocks, and only
+paks still sharing a group are fully hashed, in chunks. Every pak is listed, under
+its MD5SUM when it was hashed, or as UNIQUE when it did not need to be.
+"""
+
+import argparse
 from collections import defaultdict
+from concurrent import futures
 import hashlib
 import os
 import sys
 import zipfile
+import pakscan
 
 log = lambda *a: print(*a, file=sys.stderr)
 
-paks = []
-for path in sys.argv[1:]:
-    for dirname, _, basenames in os.walk(path):
-        for basename in basenames:
-            if basename[-4:].lower() in ('.pk3', '.dpk'):
-                paks.append(os.path.join(dirname, basename))
-log('Searching', len(paks), 'paks')
+BLOCK_SIZE = 1 << 16
+CHUNK_SIZE = 1 << 20
+
+def PartialHash(pak):
+    # the end of a zip is its central directory, which lists every member's CRC
+    md5 = hashlib.md5()
+    with open(pak, 'rb') as f:
+        md5.update(f.read(BLOCK_SIZE))
+        size = f.seek(0, os.SEEK_END)
+        if size > BLOCK_SIZE:
+            f.seek(max(BLOCK_SIZE, size - BLOCK_SIZE))
+            md5.update(f.read(BLOCK_SIZE))
+    return md5.digest()
 
-hashdir = defaultdict(list)
+def IsValidPak(pak):
+    try:
+        zipfile.ZipFile(pak).close()
+        return True
+    except zipfile.BadZipFile:
+        log("Couldn't open", pak)
+        return False
 
-for pak in paks:
+def HashPak(pak):
+    """Returns (md5, members), or None if the pak is not a valid zip."""
     assert '\n' not in pak
     try:
-        z = zipfile.ZipFile(pak)
-    except (zipfile.BadZipFile, FileNotFoundError):
+        with zipfile.ZipFile(pak) as z:
+            members = pakscan.Members(z)
+    except zipfile.BadZipFile:
         log("Couldn't open", pak)
-        continue
-    z.close()
+        return None
+    md5 = hashlib.md5()
+    buf = bytearray(CHUNK_SIZE)
+    view = memoryview(buf)
+    with open(pak, 'rb', buffering=0) as f:
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            md5.update(view[:n])
+    return md5.hexdigest(), members
+
+def Regroup(groups, key):
+    """Splits groups of paks by key(pak), dropping the paks for which it is None."""
+    # all groups are keyed at once so that they share the thread pool
+    group_keys = [group_key for group_key, group in groups.items() for pak in group]
+    paks = [pak for group in groups.values() for pak in group]
+    regrouped = defaultdict(list)
+    for group_key, pak, value in zip(group_keys, paks, key(paks)):
+        if value is not None:
+            regrouped[group_key, value].append(pak)
+    return regrouped
+
+def SplitUnique(groups, unique, hashed=False):
+    """Moves paks alone in their group to unique (with their MD5 if hashed), returns the other groups."""
+    for group_key, group in groups.items():
+        if len(group) == 1:
+            unique[group[0]] = group_key[1] if hashed else None
+    return {group_key: group for group_key, group in groups.items() if len(group) > 1}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-j', type=int, help='hashing threads (default: a few per CPU)')
+    parser.add_argument('--cache', help='SQLite file caching full hashes by path, size and mtime')
+    parser.add_argument('paths', nargs='+', help='directories containing paks, or files listing paks')
+    argv = parser.parse_args()
+
+    paks = pakscan.FindPaks(argv.paths)
+    log('Searching', len(paks), 'paks')
+    index = argv.cache and pakscan.PakIndex(argv.cache)
+
+    sizes = defaultdict(list)
+    for pak in paks:
+        try:
+            sizes[os.path.getsize(pak)].append(pak)
+        except FileNotFoundError:
+            log("Couldn't open", pak)
+    # unique paks and their MD5 if they were hashed
+    unique = {}
+    groups = SplitUnique(sizes, unique)
+    log(sum(map(len, groups.values())), 'paks with the same size')
+
+    with futures.ThreadPoolExecutor(argv.j) as executor:
+        groups = SplitUnique(Regroup(groups, lambda group: executor.map(PartialHash, group)), unique)
+        log(sum(map(len, groups.values())), 'paks with the same first and last blocks')
+
+        def FullHashes(paks):
+            # the index is not shared with the threads, which only hash uncached paks
+            keys = [index and pakscan.PakIndex.Key(pak) for pak in paks]
+            pak_ids = [index and index.PakId(pak, key) for pak, key in zip(paks, keys)]
+            cached = [index.Result(pak_id, 'md5') if pak_id else (False, None) for pak_id in pak_ids]
+            todo = [pak for pak, (found, _) in zip(paks, cached) if not found]
+            hashed = executor.map(HashPak, todo)
+            for pak, key, pak_id, (found, md5) in zip(paks, keys, pak_ids, cached):
+                if not found:
+                    result = next(hashed)
+                    md5 = result and result[0]
+                    if index and result:
+                        if not pak_id:
+                            pak_id = index.Add(pak, result[1], key)
+                        index.SetResult(pak_id, 'md5', md5)
+                yield md5
+        groups = SplitUnique(Regroup(groups, FullHashes), unique, hashed=True)
+
+        # hashed paks are checked by HashPak, only check the others
+        unchecked = [pak for pak, md5 in unique.items() if md5 is None]
+        for pak, is_valid in zip(unchecked, executor.map(IsValidPak, unchecked)):
+            if not is_valid:
+                del unique[pak]
 
-    f = open(pak, 'rb')
-    # md5 = hashlib.file_digest(f, "md5") # requires 3.11
-    md5 = hashlib.md5(f.read())
-    f.close()
-    hashdir[md5.hexdigest()].append(pak)
+    if index:
+        index.Close()
 
-for md5, paks in hashdir.items():
-    print('MD5SUM', md5)
-    print(paks[0])
-    for pak in paks[1:]:
-        print('DUPLICATE', pak)
+    duplicates = {group[0]: (md5, group) for (_, md5), group in groups.items()}
+    for pak in paks:
+        if pak in duplicates:
+            md5, group = duplicates[pak]
+            print('MD5SUM', md5)
+            print(group[0])
+            for duplicate in group[1:]:
+                print('DUPLICATE', duplicate)
+        elif pak in unique:
+            if unique[pak]:
+                print('MD5SUM', unique[pak])
+                print(pak)
+            else:
+                print('UNIQUE', pak)
 
+if __name__ == '__main__':
+    main()